@@ -0,0 +1,693 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for bbreport.
+
+The end-to-end benchmark runs bbreport against a local stand-in for the
+buildbot, and compares the timings with the saved baseline.
+
+Usage: bbbench.py [options] benchmark ...
+"""
+from __future__ import with_statement
+
+import json
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import bbreport
+
+out = bbreport.out
+b = bbreport.b
+xmlrpclib = bbreport.xmlrpclib
+
+
+def timeit(func, *args):
+    # Return the best time of 3 runs, and the result
+    best = None
+    for i in range(3):
+        start = time.time()
+        rv = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, rv
+
+
+# ~~ Buildbot stand-in ~~
+
+
+class StandIn(object):
+    """Local stand-in for the buildbot and the known issues page.
+
+    It serves the XML-RPC methods, the build pages, the stdio logs (with
+    Range requests) and the KnownIssues wiki page.  The results of the
+    builds are deterministic.
+    """
+
+    issues_page = """
+|| *issue* || *test* || *message* || *builder* ||
+|| 1234 || `test_os` || || ||
+|| 5678 || `test_hang` || `hung.*` || `host1.*` ||
+"""
+    results = ('success', 'failure', 'success', 'exception', 'failure')
+
+    def __init__(self, builders=40, last=100, log_size=100 * 1024,
+                 latency=0.0):
+        self.builders = ['host%d %s' % (idx // 2, ('2.7', '3.x')[idx % 2])
+                         for idx in range(builders)]
+        self.last = last
+        self.log_size = log_size
+        self.latency = latency
+        self.hits = 0
+        self.server = None
+
+    def result(self, name, num):
+        return self.results[(sum(map(ord, name)) + num) % 5]
+
+    def build_tuple(self, name, num):
+        result = self.result(name, num)
+        text = {'success': ['build', 'successful'],
+                'failure': ['failed', 'test'],
+                'exception': ['exception', 'test']}[result]
+        return [name, num, 0, 0, '', str(1000 + num), result, text, '']
+
+    def build_page(self, name, num):
+        (result, text) = self.build_tuple(name, num)[6:8]
+        return ('<h1>Builder %s Build #%d</h1>\n<h2>Results:</h2>\n'
+                '<span class="%s">%s</span>\n<li>Revision: %s</li>' %
+                (name, num, result, ' '.join(text), 1000 + num))
+
+    def stdio(self, name, num):
+        result = self.result(name, num)
+        lines = ['<span class="stdout">']
+        size = 0
+        idx = 0
+        while size < self.log_size:
+            line = '[%3d/400] test_%03d\n' % (idx % 400, idx % 400)
+            lines.append(line)
+            size += len(line)
+            idx += 1
+        if result == 'failure':
+            if num % 2:
+                lines.append('2 tests failed:\n    test_os test_zz%d\n' %
+                             (num % 3))
+            else:
+                lines.append('[123/400] test_hang</span>'
+                             '<span class="stdout">\n'
+                             'command timed out: 3600 seconds without '
+                             'output, killing pid 1\n'
+                             'process killed by signal 9\n')
+        elif result == 'exception':
+            lines.append('No space left on device\n')
+        return bbreport.b(''.join(lines))
+
+    def call(self, method, params):
+        # Return the result of the XML-RPC call
+        if method == 'getAllBuilders':
+            return self.builders
+        if method == 'getLastBuildsAllBuilders':
+            return [self.build_tuple(name, self.last - idx)
+                    for name in self.builders
+                    for idx in reversed(range(params[0]))]
+        if method == 'getLastBuilds':
+            (name, limit) = params
+            return [self.build_tuple(name, self.last - idx)
+                    for idx in reversed(range(limit))]
+        if method == 'system.multicall':
+            return [[self.call(call['methodName'], call['params'])]
+                    for call in params[0]]
+        raise xmlrpclib.Fault(1, 'no such method %r' % method)
+
+    def start(self):
+        """Start the server, and return its base URL."""
+        handler = type('StandInHandler', (StandInHandler, object),
+                       {'standin': self})
+        server = type('ThreadingHTTPServer',
+                      (bbreport.socketserver.ThreadingMixIn,
+                       bbreport.http_server.HTTPServer, object),
+                      {'daemon_threads': True})
+        self.server = server(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://%s:%s/' % self.server.server_address
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StandInHandler(bbreport.http_server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    standin = None
+    # Send each response at once
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, code=200, content_type='text/html', headers=()):
+        if not isinstance(body, bytes):
+            body = bbreport.b(body)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        standin = self.standin
+        standin.hits += 1
+        if standin.latency:
+            time.sleep(standin.latency)
+        path = bbreport.urllib.unquote(self.path)
+        if path.endswith('/KnownIssues.wiki'):
+            etag = '"%d"' % len(standin.issues_page)
+            if self.headers.get('If-None-Match') == etag:
+                return self.send('', 304, headers=[('ETag', etag)])
+            return self.send(standin.issues_page, headers=[('ETag', etag)])
+        parts = path.strip('/').split('/')
+        if (len(parts) not in (4, 8) or parts[0] != 'builders' or
+                parts[1] not in standin.builders):
+            return self.send('Not found', 404)
+        num = int(parts[3])
+        if num < 0:
+            num += standin.last + 1
+        if len(parts) == 4:
+            return self.send(standin.build_page(parts[1], num))
+        body = standin.stdio(parts[1], num)
+        rng = self.headers.get('Range', '')
+        if not rng.startswith('bytes=-'):
+            return self.send(body, content_type='text/plain')
+        start = max(len(body) - int(rng[7:]), 0)
+        content_range = 'bytes %d-%d/%d' % (start, len(body) - 1, len(body))
+        self.send(body[start:], 206, 'text/plain',
+                  [('Content-Range', content_range)])
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        standin = self.standin
+        standin.hits += 1
+        if standin.latency:
+            time.sleep(standin.latency)
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        (params, method) = xmlrpclib.loads(data)
+        try:
+            response = xmlrpclib.dumps((standin.call(method, params),),
+                                       methodresponse=True)
+        except xmlrpclib.Fault:
+            response = xmlrpclib.dumps(sys.exc_info()[1],
+                                       methodresponse=True)
+        self.send(response, content_type='text/xml')
+
+
+# ~~ Benchmarks ~~
+
+
+def bench_matcher(options):
+    """Issues.match() with thousands of rules."""
+    rnd = random.Random(options.seed)
+    issues = bbreport.Issues()
+    for num in range(options.rules):
+        kind = rnd.random()
+        if kind < 0.7:
+            rule = ('test_%d' % num, '', '')
+        elif kind < 0.8:
+            rule = ('test_%d.*' % num, '', '')
+        elif kind < 0.9:
+            rule = ('test_%d' % num, 'hung.*', 'host%d' % (num % 10))
+        else:
+            rule = ('', 'failed %d' % num, 'host%d.*' % (num % 10))
+        issues[str(1000 + num)] = rule
+    failures = [('test_%d' % rnd.randrange(options.rules * 2),
+                 rnd.choice(('', 'hung for 30 min')),
+                 'host%d 3.x' % rnd.randrange(10))
+                for i in range(options.failures)]
+
+    def linear():
+        # The linear scan over the issues and their rules
+        return [next((number for number, issue in issues.items()
+                      if any(rule.match(*event) for rule in issue.rules)),
+                     None) for event in failures]
+
+    def indexed():
+        matcher = bbreport.RuleMatcher(issues)
+        return [matcher.match(*event) for event in failures]
+
+    (t_linear, expected) = timeit(linear)
+    (t_indexed, result) = timeit(indexed)
+    assert result == expected
+    out('%d rules, %d failures (%d known)' %
+        (options.rules, len(failures), len(list(filter(None, expected)))))
+    out('  linear scan:  %8.3f s' % t_linear)
+    out('  rule matcher: %8.3f s  (x%.1f)' %
+        (t_indexed, t_linear / max(t_indexed, 1e-9)))
+
+
+class DictBuild(object):
+    """Build record with a __dict__, as before the __slots__."""
+
+    def __init__(self, build):
+        self.__dict__.update((name, getattr(build, name))
+                             for name in bbreport.Build.__slots__)
+        self.failed_tests = list(build.failed_tests)
+        self.failed_issues = list(build.failed_issues)
+        self._url = build.url[:-len(str(build.num))]
+
+
+def footprint(factory, count):
+    # Return the memory allocated by the objects, per object
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is None:
+        objects = [factory(idx) for idx in range(count)]
+        size = 0
+        for obj in objects:
+            size += sys.getsizeof(obj)
+            if hasattr(obj, '__dict__'):
+                size += sys.getsizeof(obj.__dict__)
+        return size / float(count)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [factory(idx) for idx in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objects
+    return size / float(count)
+
+
+def bench_memory(options):
+    """Memory footprint of the builds and the issue events."""
+    count = options.builds
+    rows = [('host%d 3.x' % (idx % 100), idx, 80000 + idx,
+             bbreport.S_FAILURE, 'test', None) for idx in range(count)]
+    builds = [bbreport.Build.from_cache(row) for row in rows]
+    for build in builds:
+        build.failed_tests.append('test_os')
+
+    results = [
+        ('build, with __dict__', lambda idx: DictBuild(builds[idx])),
+        ('build, with __slots__',
+         lambda idx: bbreport.Build.from_cache(rows[idx])),
+        ('event, BuildRef', lambda idx: bbreport.BuildRef(builds[idx])),
+    ]
+    out('%d builds' % count)
+    for (label, factory) in results:
+        out('  %-24s %6.0f bytes per object' %
+            (label, footprint(factory, count)))
+    out('  (an event referencing the Build object keeps it alive)')
+
+
+class LineParser(bbreport.StdioParser):
+    """The previous stdio parser, which handles the lines one by one."""
+
+    def __init__(self):
+        bbreport.StdioParser.__init__(self)
+        self._partial = b('')
+        self._lines = bbreport.collections.deque()
+        self._size = 0
+
+    def feed(self, data):
+        lines = (self._partial + data).split(b('\n'))
+        self._partial = lines.pop()
+        for line in lines:
+            self._feed_line(line)
+
+    def _feed_line(self, line):
+        line = line.replace(bbreport.HTMLNOISE, b(''))
+        if line[-1:] == b('\r'):
+            line = line[:-1]
+        for line in line.split(b('\r')):
+            self._parse_line(line)
+
+    def _parse_line(self, line):
+        if self.failed_tests is None:
+            if self._failed_lines is not None:
+                if line[:1] == b(' ') and len(line) > 1:
+                    self._failed_lines.append(line)
+                else:
+                    self._end_failed()
+            if self._failed_lines is None and self.failed_tests is None:
+                fail = bbreport.RE_FAILED.search(line)
+                if fail:
+                    self._failed_count = fail.group(1)
+                    line = line[fail.end():]
+                    if not line:
+                        self._failed_lines = []
+                    elif line[:1] == b(' ') and len(line) > 1:
+                        self._failed_lines = [line]
+        if self.error is None:
+            self.error = next((e for e in bbreport.OSERRORS if e in line),
+                              None)
+        self._lines.append(line)
+        self._size += len(line) + 1
+        while self._size > bbreport.STDIO_TAIL and len(self._lines) > 1:
+            line = self._lines.popleft()
+            self._size -= len(line) + 1
+            if self.failed_tests is None and self.error is None:
+                failed = bbreport.RE_TEST.match(line)
+                if failed:
+                    self._last_test = failed.group(1)
+
+    def flush(self):
+        if self._partial:
+            self._feed_line(self._partial)
+            self._partial = b('')
+
+    def has_verdict(self):
+        self.flush()
+        if self._failed_lines:
+            return True
+        return self.failed_tests is not None or self.error is not None
+
+    def close(self):
+        self.flush()
+        self._tail = b('').join(line + b('\n') for line in self._lines)
+        return bbreport.StdioParser.close(self)
+
+
+def stdio_logs(rnd, size):
+    # Return the sample logs: a regular log, then the adversarial ones
+    def lines(make):
+        rv = []
+        pos = 0
+        while pos < size:
+            rv.append(make(len(rv)))
+            pos += len(rv[-1])
+        data = b('').join(rv)
+        # Truncate after a newline
+        return data[:data.rfind(b('\n'), 0, size) + 1 or size]
+    tests = lines(lambda pos: b('[%3d/400] test_%d\n' % (pos % 400, pos)))
+    yield 'regular', (tests + b('2 tests failed:\n    test_os test_io\n'))
+    yield 'crashed', (tests + b('[400/400] test_zz</span>'
+                                '<span class="stdout">\ncommand timed out: '
+                                '3600 seconds without output\n'
+                                'process killed by signal 9\n'))
+    yield 'long digits', (b('1') * size + b(' tests failed:\n test_os\n'))
+    yield 'carriage returns', (b('\r') * size + b('test_os\n'))
+    yield 'one line', (b('x') * size + b(' 1 test failed: test_os'))
+    yield 'headers', (b('x tests failed: ') * (size // 16) +
+                      b('\n0 tests failed:\n'))
+    yield 'brackets', (b('[') * size + b(' test_os\n'))
+    yield 'noise', (bbreport.HTMLNOISE * (size // len(bbreport.HTMLNOISE)) +
+                    b('No space left on device\n'))
+    yield 'random', lines(lambda pos: rnd.choice(
+        (b('test_%d\n' % pos), b('  '), b('\r'), b('\r\n'), b('1 '),
+         b('test failed:'), b('[1] '), b('</span>'), b(' test_x\n'))))
+
+
+def parse_stdio(factory, data, chunks):
+    parser = factory()
+    pos = 0
+    try:
+        for size in chunks:
+            parser.feed(data[pos:pos + size])
+            pos += size
+        parser.feed(data[pos:])
+        return parser.has_verdict(), parser.close()
+    except AssertionError:
+        return 'count mismatch'
+
+
+def bench_stdio(options):
+    """Stdio parser, compared with the previous line by line parser."""
+    rnd = random.Random(options.seed)
+    size = options.log_size * 1024
+    out('%d kB logs, in chunks of 8 kB' % options.log_size)
+    out('  %-18s %10s %10s' % ('log', 'lines', 'scanner'))
+    for (label, data) in stdio_logs(rnd, size):
+        # The same results, whatever the chunks
+        for chunk in (8192, 1, None):
+            if chunk is None:
+                chunks = [rnd.randint(1, 4096) for i in range(size // 2048)]
+            else:
+                chunks = [chunk] * min(size // chunk, 20000)
+            expected = parse_stdio(LineParser, data, chunks)
+            assert parse_stdio(bbreport.StdioParser, data, chunks) == \
+                expected, (label, chunk)
+        chunks = [8192] * (len(data) // 8192)
+        (t_lines, _) = timeit(parse_stdio, LineParser, data, chunks)
+        (t_scan, _) = timeit(parse_stdio, bbreport.StdioParser, data, chunks)
+        out('  %-18s %8.3f s %8.3f s  (x%.1f)' %
+            (label, t_lines, t_scan, t_lines / max(t_scan, 1e-9)))
+    # The lines longer than the kept tail, at a few MB
+    out('Logs without newline, in chunks of 64 kB')
+    out('  %-18s %10s %10s %10s' % ('log', '4 MB', '8 MB', '16 MB'))
+    for (label, line) in (('one line', b('x')),
+                          ('carriage returns', b('x\r'))):
+        times = []
+        for mbytes in (4, 8, 16):
+            data = (b('No space left on device ') +
+                    line * (mbytes * 1024 * 1024 // len(line)) +
+                    b('\n1 test failed:\n test_os\n'))
+            chunks = [65536] * (len(data) // 65536)
+            (t_scan, results) = timeit(parse_stdio, bbreport.StdioParser,
+                                       data, chunks)
+            assert results == (True, (['test_os'], bbreport.S_EXCEPTION,
+                                      'no space left on device')), results
+            times.append(t_scan)
+        out('  %-18s %8.3f s %8.3f s %8.3f s' % ((label,) + tuple(times)))
+
+
+def bench_processes(options):
+    """Stdio logs parsed by the process pool, with 1 to N processes."""
+    rnd = random.Random(options.seed)
+    size = options.log_size * 1024
+    logs = [data for (label, data) in stdio_logs(rnd, size)
+            if label in ('regular', 'crashed', 'carriage returns')]
+    logs = (logs * options.logs)[:options.logs]
+    cpus = bbreport.multiprocessing.cpu_count()
+    out('%d logs of %d kB, %d CPU(s)' % (len(logs), options.log_size, cpus))
+    (t_inline, expected) = timeit(bbreport.map_stdio, logs)
+    out('  %-18s %8.3f s' % ('no pool', t_inline))
+    processes = 1
+    while processes <= max(cpus, 2):
+        bbreport.start_parse_pool(processes)
+        try:
+            (t_pool, result) = timeit(bbreport.map_stdio, logs)
+        finally:
+            bbreport.stop_parse_pool()
+        assert result == expected
+        out('  %-18s %8.3f s  (x%.1f)' % ('%d process(es)' % processes,
+                                          t_pool, t_inline / t_pool))
+        processes *= 2
+
+
+def bench_analytics(options):
+    """Statistics of --mode stats, over a large local cache."""
+    rnd = random.Random(options.seed)
+    tmpdir = tempfile.mkdtemp(prefix='bbbench')
+    saved = (bbreport.dbfile, bbreport.conn)
+    try:
+        bbreport.dbfile = os.path.join(tmpdir, 'bbreport.sqlite')
+        bbreport.conn = None
+        bbreport.load_database()
+        names = ['host%d 3.x' % idx for idx in range(100)]
+        tests = ['test_%d' % idx for idx in range(options.rules // 10)]
+        builds = []
+        failures = []
+        for num in range(options.builds // len(names)):
+            for name in names:
+                result = rnd.choice((bbreport.S_SUCCESS,) * 3 +
+                                    (bbreport.S_FAILURE,
+                                     bbreport.S_EXCEPTION))
+                builds.append((name, num, 80000 + num, result, ''))
+                if result == bbreport.S_FAILURE:
+                    failures.extend((name, num, test)
+                                    for test in rnd.sample(tests, 2))
+        bbreport.conn.executemany('INSERT INTO builds(builder, build, '
+                                  'revision, result, message) '
+                                  'VALUES (?, ?, ?, ?, ?)', builds)
+        bbreport.conn.executemany('INSERT INTO failures(builder, build, '
+                                  'failed) VALUES (?, ?, ?)', failures)
+        bbreport.conn.commit()
+        out('%d builds of %d builders, %d failures of %d tests' %
+            (len(builds), len(names), len(failures), len(tests)))
+        (t_builders, rows) = timeit(bbreport.query_builder_stats, names)
+        out('  builders:   %8.3f s  (%d rows)' % (t_builders, len(rows)))
+        (t_tests, rows) = timeit(bbreport.query_test_stats, names)
+        out('  tests:      %8.3f s  (%d rows)' % (t_tests, len(rows)))
+    finally:
+        bbreport.close_database()
+        (bbreport.dbfile, bbreport.conn) = saved
+        shutil.rmtree(tmpdir)
+
+
+def run_python(args, stderr=None):
+    # Run the interpreter in the directory of bbreport, and return the time
+    cwd = os.path.dirname(os.path.abspath(bbreport.__file__))
+    start = time.time()
+    proc = subprocess.Popen([sys.executable] + args, cwd=cwd,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (stdout, errors) = proc.communicate()
+    elapsed = time.time() - start
+    if proc.returncode:
+        raise RuntimeError(errors.decode('utf-8', 'replace'))
+    if stderr is not None:
+        stderr.append(errors.decode('utf-8', 'replace'))
+    return elapsed
+
+
+def bench_startup(options):
+    """Startup time of "bbreport --offline -qq", budget 50 ms."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        conffile = os.path.join(tmpdir, 'bbreport.conf')
+        with open(conffile, 'w') as f:
+            f.write('[global]\ndbfile = %s\n' %
+                    os.path.join(tmpdir, 'bbreport.sqlite'))
+        script = os.path.abspath(bbreport.__file__).replace('.pyc', '.py')
+        # The first run creates the database, and compiles the modules
+        commands = [
+            ('interpreter', ['-c', 'pass']),
+            ('import bbreport', ['-c', 'import bbreport']),
+            ('bbreport.py', [script, '--conf', conffile, '-o', '-qq']),
+            # The bytecode of the module is cached, unlike the script
+            ('-m bbreport', ['-m', 'bbreport', '--conf', conffile,
+                             '-o', '-qq']),
+        ]
+        for (label, args) in commands:
+            run_python(args)
+            best = min(run_python(args) for i in range(options.repeat))
+            out('  %-16s %8.1f ms' % (label, best * 1000))
+        out('  %s' % ('OK' if best < 0.05 else 'over budget'))
+
+        if sys.version_info >= (3, 7):
+            # Slowest imports, with "-X importtime"
+            stderr = []
+            run_python(['-X', 'importtime'] + commands[-1][1], stderr)
+            imports = []
+            for line in stderr[0].splitlines():
+                if line.startswith('import time:') and '|' in line:
+                    (self_us, cumul_us, name) = line[12:].split('|')
+                    if not name.startswith('  ') and cumul_us.strip() != \
+                            'cumulative':
+                        imports.append((int(cumul_us), name.strip()))
+            out('  slowest imports:')
+            for (cumul_us, name) in sorted(imports, reverse=True)[:8]:
+                out('    %-20s %6.1f ms' % (name, cumul_us / 1000.))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_e2e(options):
+    """Cold cache, warm cache and offline runs against a stand-in."""
+    standin = StandIn(options.builders, log_size=options.log_size * 1024,
+                      latency=options.latency / 1000.)
+    url = standin.start()
+    tmpdir = tempfile.mkdtemp()
+    timings = {}
+    try:
+        conffile = os.path.join(tmpdir, 'bbreport.conf')
+        with open(conffile, 'w') as f:
+            f.write('[global]\nbaseurl = %s\nissuesurl = %s\n' %
+                    (url, url + 'KnownIssues.wiki'))
+            for name in ('dbfile', 'dumpfile', 'jsonfile'):
+                path = os.path.basename(getattr(bbreport, name))
+                f.write('%s = %s\n' % (name, os.path.join(tmpdir, path)))
+        script = os.path.abspath(bbreport.__file__).replace('.pyc', '.py')
+        out('%d builders, logs of %d kB, latency %d ms, args: %s' %
+            (options.builders, options.log_size, options.latency,
+             options.args or '(none)'))
+        out('  %-20s %10s %10s %10s' % ('', 'best', 'baseline', 'requests'))
+        args = [script, '--conf', conffile, '-b', 'all', '--no-color']
+        args += options.args.split()
+        for mode in ('builder', 'revision', 'issue', 'json'):
+            for phase in ('cold', 'warm', 'offline'):
+                command = args + ['--mode', mode]
+                if phase == 'offline':
+                    command.append('-o')
+                best = None
+                for idx in range(options.runs):
+                    if phase == 'cold':
+                        for name in os.listdir(tmpdir):
+                            if name.startswith('bbreport.sqlite'):
+                                os.remove(os.path.join(tmpdir, name))
+                    hits = standin.hits
+                    elapsed = run_python(command)
+                    if best is None or elapsed < best:
+                        best = elapsed
+                    hits = standin.hits - hits
+                timings['%s %s' % (mode, phase)] = (best, hits)
+    finally:
+        shutil.rmtree(tmpdir)
+        standin.stop()
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    for (label, (best, hits)) in sorted(timings.items()):
+        previous = baseline.get(label)
+        if previous:
+            ratio = '%8.2fx' % (best / previous[0])
+        else:
+            ratio = '%9s' % '-'
+        out('  %-20s %8.3f s %s %10d' % (label, best, ratio, hits))
+    if options.save:
+        with open(options.baseline, 'w') as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+        out('  baseline saved to %s' % options.baseline)
+
+
+BENCHMARKS = dict((name[6:], func) for (name, func) in globals().items()
+                  if name.startswith('bench_'))
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--seed', default=42, type='int',
+                      help='seed of the random generator')
+    parser.add_option('--rules', default=3000, type='int',
+                      help='number of issue rules (default: %default)')
+    parser.add_option('--builds', default=50000, type='int',
+                      help='number of builds (default: %default)')
+    parser.add_option('--failures', default=2000, type='int',
+                      help='number of failed tests (default: %default)')
+    parser.add_option('--repeat', default=10, type='int',
+                      help='number of runs of a command (default: %default)')
+    parser.add_option('--runs', default=3, type='int',
+                      help='number of runs of the end-to-end scenarios '
+                           '(default: %default)')
+    parser.add_option('--builders', default=40, type='int',
+                      help='number of builders of the stand-in server '
+                           '(default: %default)')
+    parser.add_option('--latency', default=0, type='int',
+                      help='latency of the stand-in server, in ms')
+    parser.add_option('--log-size', default=100, type='int',
+                      help='size of the stdio logs, in kB (default: %default)')
+    parser.add_option('--logs', default=64, type='int',
+                      help='number of stdio logs parsed by the process pool '
+                           '(default: %default)')
+    parser.add_option('--args', default='',
+                      help='additional arguments of bbreport, e.g. "-j 8"')
+    parser.add_option('--baseline', default='bbbench.baseline',
+                      help='file of the end-to-end timings to compare with '
+                           '(default: %default)')
+    parser.add_option('--save', default=False, action='store_true',
+                      help='save the end-to-end timings as the baseline')
+    options, args = parser.parse_args()
+    for name in args or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r, choose from: %s' %
+                         (name, ', '.join(sorted(BENCHMARKS))))
+        out('%s: %s' % (name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name](options)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,54 +4,128 @@ from __future__ import with_statement
 
 import collections
 import fnmatch
-import gzip
+import operator
 import optparse
 import os
 import re
-import shutil
-import socket
-import sqlite3
 import sys
+import threading
+import time
 from contextlib import closing
 from datetime import datetime
+from io import BytesIO
 
-try:
-    import simplejson as json
-except ImportError:
-    import json
+
+class LazyModule(object):
+    """Module imported on first use: the first one available of names.
+
+    The modules which are not needed by every mode are imported lazily,
+    to keep the startup fast.
+    """
+
+    def __init__(self, *names):
+        self._names = names
+
+    def __getattr__(self, attr):
+        module = self.__dict__.get('_module')
+        if module is None:
+            for name in self._names:
+                try:
+                    __import__(name)
+                except ImportError:
+                    if name == self._names[-1]:
+                        raise
+                    continue
+                module = self._module = sys.modules[name]
+                break
+        return getattr(module, attr)
+
+gzip = LazyModule('gzip')
+hashlib = LazyModule('hashlib')
+json = LazyModule('simplejson', 'json')
+multiprocessing = LazyModule('multiprocessing')
+shutil = LazyModule('shutil')
+signal = LazyModule('signal')
+socket = LazyModule('socket')
+sqlite3 = LazyModule('sqlite3')
 
 try:
     # Python 2.x
-    import urllib2
-    import urllib
-    import xmlrpclib
     from ConfigParser import ConfigParser
+    from Queue import Queue
+    from urlparse import urljoin, urlsplit
+    httplib = LazyModule('httplib')
+    urllib2 = LazyModule('urllib2')
+    urllib = LazyModule('urllib')
+    xmlrpclib = LazyModule('xmlrpclib')
+    http_server = LazyModule('BaseHTTPServer')
+    socketserver = LazyModule('SocketServer')
 except ImportError:
     # Python 3.x
-    import urllib.request as urllib2
-    import urllib.parse as urllib
-    import xmlrpc.client as xmlrpclib
     from configparser import ConfigParser
-
-try:
-    # ANSI color support on Windows
-    import colorama
-    colorama.init()
-except ImportError:
-    pass
+    from queue import Queue
+    from urllib.parse import urljoin, urlsplit
+    httplib = LazyModule('http.client')
+    urllib2 = LazyModule('urllib.request')
+    urllib = LazyModule('urllib.parse')
+    xmlrpclib = LazyModule('xmlrpc.client')
+    http_server = LazyModule('http.server')
+    socketserver = LazyModule('socketserver')
 
 __version__ = '0.1dev'
 
 # Default number of builds
 NUMBUILDS = 4
+# Refresh the list of builders after BUILDERS_TTL seconds (0 to always)
+BUILDERS_TTL = 3600
 # The XMLRPC methods may give an error with larger requests
 XMLRPC_LIMIT = 5
+# Number of XMLRPC calls batched in a MultiCall request (1 to disable)
+MULTICALL_CHUNK = 20
+# Retention of the cached builds: keep the last CACHE_BUILDS builds,
+# the builds of the last CACHE_DAYS days, and the last failure
 CACHE_BUILDS = 50
+CACHE_DAYS = 0
+CACHE_LAST_FAILURE = 1
 DEFAULT_BRANCHES = 'all'
 DEFAULT_FAILURES = ''
 DEFAULT_TIMEOUT = 4
+# Size of the end of the stdio log kept to find the last running test
+STDIO_TAIL = 256 * 1024
+# Size of the end of the stdio log retrieved first (0 to disable),
+# ignored when the logs are stored (LOGSTORE_SIZE).  The whole log is
+# retrieved if its end has no failed tests and no OS error; an OS error
+# before failed tests at the end is not reported then.
+STDIO_RANGE = 256 * 1024
+# Size of the store of the compressed stdio logs in MB (0 to disable),
+# used to --reparse the cached builds; the whole logs are retrieved
+LOGSTORE_SIZE = 0
+# Number of builders retrieved in parallel
+DEFAULT_JOBS = 1
+# Number of processes which parse the stdio logs (0 to parse in the threads)
+DEFAULT_PROCESSES = 0
+# Number of stored logs parsed at once, with --reparse
+REPARSE_CHUNK = 50
+# Seconds before retrieving again the page of a build in progress
+BUILDING_TTL = 120
+# Seconds before retrying the build pages of a host after a failure,
+# doubled after each failure up to BACKOFF_MAX
+BACKOFF_MIN = 120
+BACKOFF_MAX = 3600
+# With --watch, interval between two commits to the local cache (seconds)
+WATCH_CHECKPOINT = 300
+# With --serve, default interval between two refreshes (seconds)
+SERVE_INTERVAL = 60
+# Idle HTTP connections kept open, per host
+HTTP_POOLSIZE = 8
 MSG_MAXLENGTH = 60
 MAX_FAILURES = 30
+# Number of builders per query to the local cache
+QUERY_CHUNK = 200
+# Number of pending builders and builds written at once to the local cache
+FLUSH_THRESHOLD = 500
+# Number of test patterns combined in one regular expression
+MATCHER_GROUP = 50
 DEFAULT_OUTPUT = {}
 BUILD_ID = 'revision'
 ANSI_COLOR = ['black', 'red', 'green', 'yellow',
@@ -64,14 +138,26 @@ issuesurl = 'http://wiki.bbreport.googlecode.com/hg/KnownIssues.wiki'
 basefile = os.path.splitext(__file__)[0]
 conffile = basefile + '.conf'
 # Database file
-dbfile = basefile + '.cache'
+dbfile = basefile + '.sqlite'
+# Database dump (bbreport <= 0.1), imported once in the database file
+dumpfile = basefile + '.cache'
 # Generated JSON file (option --mode json)
 jsonfile = basefile + '.json'
+# Store of the stdio logs (see LOGSTORE_SIZE)
+logdir = basefile + '.logs'
 
 # Database connection
 conn = None
-# Count removed builds
-removed_builds = 0
+# Report server (option --serve)
+report_server = None
+# Statistics of the run (option --stats)
+stats = None
+# Time when the builds are no longer retrieved (option --deadline)
+deadline = None
+# Processes which parse the stdio logs (option --processes)
+parse_pool = None
+# Serialize the database access when builders are retrieved in parallel
+dblock = threading.RLock()
 
 # Common statuses for Builds and Builders
 S_BUILDING = 'building'
@@ -93,11 +179,20 @@ RE_BUILD = re.compile(b('Build #(\d+)</h1>\r?\n?'
                         '<h2>Results:</h2>\r?\n?'
                         '<span class="([^"]+)">([^<]+)</span>'))
 RE_BUILD_REVISION = re.compile(b('<li>Revision: (\d+)</li>'))
-RE_FAILED = re.compile(b('(\d+) tests? failed:((?:\r?\n? +([^\r\n]+))+)'))
+# The failed tests are listed on the next indented lines
+RE_FAILED = re.compile(b('(\d+) tests? failed:'))
 RE_TIMEOUT = re.compile(b('command timed out: (\d+) ([^,]+)'))
 RE_STOP = re.compile(b('(process killed by .+)'))
 RE_BBTEST = re.compile(b('make: \*\*\* \[buildbottest\] (.+)'))
 RE_TEST = re.compile(b('(?:\[[^]]*\] )?(test_[^ <]+)(?:</span>|$)'))
+# RE_FAILED and RE_TEST, for the lines of a block
+RE_FAILED_END = re.compile(b(' tests? failed:'))
+RE_TEST_LINE = re.compile(b('^(?:\[[^]\n]*\] )?(test_[^ <\n]+)(?:</span>|$)'),
+                          re.M)
+RE_LAST_TEST = re.compile(b('.*') + RE_TEST_LINE.pattern, re.M | re.S)
+DIGITS = b('0123456789')
+# A test name without special characters, in the known issues
+RE_TEST_NAME = re.compile('\w+$')
 
 # Buildbot errors
 OSERRORS = (b('filesystem is full'),
@@ -119,13 +214,6 @@ _escape_sequence = {}
 
 # ~~ Compatibility with Python 2.5 ~~
 
-if not hasattr(sqlite3.Connection, 'iterdump'):
-    try:
-        from pysqlite2 import dbapi2 as sqlite3
-        sqlite3.Connection.iterdump
-    except (ImportError, AttributeError):
-        sys.exit("*** Requires pysqlite 2.5.0 or Python >= 2.6")
-
 try:
     from collections import MutableMapping
 except ImportError:
@@ -178,6 +266,14 @@ def prepare_output():
         with_color in ('false', '0', 'off', 'no')):
         cformat = _cformat_plain
 
+    if cformat == _cformat_color:
+        try:
+            # ANSI color support on Windows
+            import colorama
+            colorama.init()
+        except ImportError:
+            pass
+
 
 def _cformat_plain(text, status, sep=' '):
     # Straight output: statuses are represented with symbols
@@ -206,13 +302,22 @@ def trunc(tests, length):
     return text, length
 
 
-def urlread(url):
+def urlread(url, consume=None):
     # Return an empty string on IOError
+    # If consume is given, it receives the data by chunks, instead
     try:
-        resource = urllib2.urlopen(url)
-        return resource.read()
-    except IOError:
+        status, headers, data = http_pool.request('GET', url,
+                                                  consume=consume)
+    except (IOError, httplib.HTTPException):
+        return b('')
+    if status != httplib.OK:
         return b('')
+    return data
+
+
+def deadline_expired():
+    """Check if the deadline of the run is passed (option --deadline)."""
+    return deadline is not None and time.time() >= deadline
 
 
 def parse_builder_name(name):
@@ -227,21 +332,340 @@ def parse_builder_name(name):
     return host, branch
 
 
+def parallel_map(func, items, jobs=1):
+    """Yield func(item) for each item, in order.
+
+    The results are computed by a pool of `jobs` threads.
+    """
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    queue = Queue()
+    results = [None] * len(items)
+    done = [threading.Event() for item in items]
+
+    def worker():
+        while True:
+            idx = queue.get()
+            if idx is None:
+                return
+            try:
+                results[idx] = (True, func(items[idx]))
+            except Exception:
+                results[idx] = (False, sys.exc_info()[1])
+            done[idx].set()
+
+    for idx in range(len(items)):
+        queue.put(idx)
+    for i in range(min(jobs, len(items))):
+        queue.put(None)
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    for idx in range(len(items)):
+        while not done[idx].isSet():
+            # Use a timeout to allow KeyboardInterrupt
+            done[idx].wait(0.5)
+        success, rv = results[idx]
+        results[idx] = None
+        if not success:
+            raise rv
+        yield rv
+
+
+# ~~ Statistics ~~
+
+
+class Stats(object):
+    """Timings and counters of the run, for the --stats option.
+
+    The hooks check the global "stats" first, which is None without the
+    option.  The counters are shared by the threads.
+    """
+
+    slowest = 5
+
+    def __init__(self):
+        self.start = self._last = time.time()
+        self.lock = threading.Lock()
+        # Wall time of the phases of the main function, in order
+        self.phases = []
+        # Count, bytes and seconds, per type of request
+        self.requests = {}
+        # Hits and misses of the local cache
+        self.cache = {'builds': [0, 0], 'failures': [0, 0],
+                      'build pages': [0, 0]}
+        # Time spent in some functions, summed over the threads
+        self.timers = {}
+        self.builders = []
+
+    def end_phase(self, name):
+        now = time.time()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def add_request(self, method, url, size, seconds):
+        path = urlsplit(url)[2]
+        if method == 'POST' and path.endswith('/xmlrpc'):
+            kind = 'xmlrpc'
+        elif path.endswith('/logs/stdio'):
+            kind = 'stdio log'
+        elif '/builds/' in path:
+            kind = 'build page'
+        elif url == issuesurl:
+            kind = 'known issues'
+        else:
+            kind = 'other'
+        with self.lock:
+            counters = self.requests.setdefault(kind, [0, 0, 0.0])
+            counters[0] += 1
+            counters[1] += size
+            counters[2] += seconds
+
+    def add_cache(self, name, hit):
+        with self.lock:
+            self.cache[name][0 if hit else 1] += 1
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def add_builder(self, name, seconds):
+        with self.lock:
+            self.builders.append((seconds, name))
+
+    def timed_builders(self, func):
+        """Wrap func(builder), to record the time per builder."""
+        def timed(builder):
+            start = time.time()
+            try:
+                return func(builder)
+            finally:
+                self.add_builder(str(builder), time.time() - start)
+        return timed
+
+    def as_dict(self):
+        """Return the statistics, to dump as JSON."""
+        return {
+            'total': time.time() - self.start,
+            'phases': self.phases,
+            'requests': dict((kind, {'count': count, 'bytes': size,
+                                     'seconds': seconds})
+                             for (kind, (count, size, seconds))
+                             in self.requests.items()),
+            'cache': dict((name, {'hits': hits, 'misses': misses})
+                          for (name, (hits, misses)) in self.cache.items()),
+            'timers': self.timers,
+            'slowest_builders': [(name, seconds) for (seconds, name) in
+                                 sorted(self.builders, reverse=True)
+                                 [:self.slowest]],
+        }
+
+    def display(self):
+        rv = self.as_dict()
+        out()
+        out('Statistics:')
+        for (name, seconds) in rv['phases']:
+            out('  %-24s %8.3f s' % (name, seconds))
+        out('  %-24s %8.3f s' % ('total', rv['total']))
+        out('%-26s %7s %8s %8s' % ('Requests:', 'count', 'kB', 'time'))
+        for (kind, counters) in sorted(rv['requests'].items()):
+            out('  %-24s %7d %8.1f %8.3f s' %
+                (kind, counters['count'], counters['bytes'] / 1024.,
+                 counters['seconds']))
+        out('%-26s %7s %8s' % ('Local cache:', 'hits', 'misses'))
+        for (name, counters) in sorted(rv['cache'].items()):
+            out('  %-24s %7d %8d' % (name, counters['hits'],
+                                     counters['misses']))
+        out('Time spent in:')
+        for (name, seconds) in sorted(rv['timers'].items()):
+            out('  %-24s %8.3f s' % (name, seconds))
+        out('Slowest builders:')
+        for (name, seconds) in rv['slowest_builders']:
+            out('  %-24s %8.3f s' % (name, seconds))
+
+
+def end_phase(name):
+    """Record the wall time since the previous phase, with --stats."""
+    if stats is not None:
+        stats.end_phase(name)
+
+
+# ~~ HTTP transport ~~
+
+
+class HTTPPool(object):
+    """Persistent HTTP/1.1 connections, pooled per host.
+
+    The connections are shared by the threads, and they are reused
+    as long as the server keeps them alive.
+    """
+
+    max_redirects = 5
+    chunk_size = 64 * 1024
+
+    def __init__(self, poolsize=None):
+        self.poolsize = poolsize
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._proxies = None
+
+    def _connect(self, key, timeout):
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=timeout)
+        return httplib.HTTPConnection(netloc, timeout=timeout)
+
+    def _acquire(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+        if connection is None:
+            return self._connect(key, timeout), False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def _release(self, key, connection):
+        poolsize = self.poolsize or HTTP_POOLSIZE
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < poolsize:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle.clear()
+
+    def request(self, method, url, body=None, headers=None, consume=None):
+        """Send the request and return (status, headers, body).
+
+        The redirections are followed for the GET requests.
+        If consume is given, the body of a successful response is passed
+        to it by chunks, and the returned body is empty.
+        """
+        for i in range(self.max_redirects + 1):
+            status, rheaders, data = self._request(method, url, body, headers,
+                                                   consume)
+            location = rheaders.get('location')
+            if (method != 'GET' or not location or status not in
+                (httplib.MOVED_PERMANENTLY, httplib.FOUND,
+                 httplib.SEE_OTHER, httplib.TEMPORARY_REDIRECT)):
+                break
+            url = urljoin(url, location)
+        return status, rheaders, data
+
+    def _request(self, method, url, body, headers, consume):
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        if self._proxies is None:
+            self._proxies = urllib2.getproxies()
+        proxy = scheme == 'http' and self._proxies.get(scheme)
+        if proxy and not urllib2.proxy_bypass(netloc.split(':')[0]):
+            # The proxy expects the absolute URL
+            key = tuple(urlsplit(proxy)[:2])
+            path = url
+        else:
+            key = (scheme, netloc)
+            path = (path or '/') + ('?' + query if query else '')
+        headers = dict(headers or ())
+        headers.setdefault('Host', netloc)
+        headers.setdefault('User-Agent', 'bbreport/' + __version__)
+        if stats is not None or deadline is not None:
+            start = time.time()
+        timeout = DEFAULT_TIMEOUT
+        if deadline is not None:
+            # Do not wait after the deadline
+            if start >= deadline:
+                raise socket.timeout('deadline exceeded')
+            timeout = min(timeout, deadline - start)
+        while True:
+            (connection, reused) = self._acquire(key, timeout)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except (IOError, httplib.HTTPException):
+                connection.close()
+                if reused:
+                    # The server closed an idle connection: retry
+                    continue
+                raise
+            break
+        try:
+            if consume is None or response.status != httplib.OK:
+                data = response.read()
+                size = len(data)
+            else:
+                data = b('')
+                size = 0
+                chunk = response.read(self.chunk_size)
+                while chunk:
+                    size += len(chunk)
+                    consume(chunk)
+                    if deadline_expired():
+                        raise socket.timeout('deadline exceeded')
+                    chunk = response.read(self.chunk_size)
+        except (IOError, httplib.HTTPException):
+            connection.close()
+            raise
+        if stats is not None:
+            stats.add_request(method, url, size, time.time() - start)
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        rheaders = dict((k.lower(), v) for (k, v) in response.getheaders())
+        return response.status, rheaders, data
+
+
+class PooledTransport(object):
+    """XML-RPC transport using the persistent HTTP connections."""
+
+    def __init__(self, scheme='http'):
+        self.scheme = scheme
+
+    def request(self, host, handler, request_body, verbose=0):
+        url = '%s://%s%s' % (self.scheme, host, handler)
+        headers = {'Content-Type': 'text/xml'}
+        (status, headers, data) = http_pool.request('POST', url,
+                                                    request_body, headers)
+        if status != httplib.OK:
+            raise xmlrpclib.ProtocolError(host + handler, status,
+                                          httplib.responses.get(status, ''),
+                                          headers)
+        parser, unmarshaller = xmlrpclib.getparser()
+        parser.feed(data)
+        parser.close()
+        return unmarshaller.close()
+
+# Instanciate a global pool of HTTP connections
+http_pool = HTTPPool()
+
+
 # ~~ Builder and Build classes ~~
 
 
 class Builder(object):
     """Represent a builder."""
 
-    saved = status = None
-    lastbuild = 0
+    __slots__ = ('name', 'host', 'branch', 'builds', 'saved', 'status',
+                 'lastbuild')
 
-    def __init__(self, name):
+    def __init__(self, name, row=None):
+        # The row (lastbuild, status) may be already read from the cache
         self.name = name
         self.host, self.branch = parse_builder_name(name)
-        self.url = baseurl + 'builders/' + urllib.quote(name)
         self.builds = {}
-        self._load_builder()
+        self.saved = self.status = None
+        self.lastbuild = 0
+        self._load_builder(row)
         if not self.saved:
             self.save()
 
@@ -250,9 +674,44 @@ class Builder(object):
         """Return the builders from the database, as a dict."""
         if conn is None:
             return {}
-        cur = conn.execute('SELECT builder FROM builders WHERE status '
-                           'IS NULL OR status <> ?', (S_MISSING,))
-        return dict((name, cls(name)) for (name,) in cur.fetchall())
+        cur = conn.execute('SELECT builder, lastbuild, status FROM builders '
+                           'WHERE status IS NULL OR status <> ?', (S_MISSING,))
+        return dict((row[0], cls(row[0], row[1:])) for row in cur.fetchall())
+
+    @classmethod
+    def query_saved_builds(cls, builders, n):
+        """Retrieve the last n builds of the builders from the local cache.
+
+        Return a dict of the lists of builds, by builder name.
+        """
+        saved_builds = dict((str(builder), []) for builder in builders)
+        if conn is None:
+            return saved_builds
+        names = sorted(saved_builds)
+        unit_of_work.flush()
+        # Read the builds and their failures by chunks of builders
+        for idx in range(0, len(names), QUERY_CHUNK):
+            chunk = names[idx:idx + QUERY_CHUNK]
+            cur = conn.execute(
+                'SELECT b.builder, b.build, b.revision, b.result, b.message, '
+                'b.rules_digest, f.failed, f.issue FROM builds AS b '
+                'LEFT JOIN failures AS f '
+                'ON f.builder = b.builder AND f.build = b.build '
+                'WHERE b.builder IN (%s) AND (SELECT COUNT(*) FROM builds '
+                'AS newer WHERE newer.builder = b.builder AND newer.build > '
+                'b.build) < ? ORDER BY b.builder, b.build DESC, f.rowid' %
+                ', '.join('?' * len(chunk)), tuple(chunk) + (n,))
+            build = None
+            for row in cur.fetchall():
+                if build is None or (build.builder, build.num) != row[:2]:
+                    build = Build.from_cache(row[:6])
+                    saved_builds[build.builder].append(build)
+                if row[6] is not None and build.failed_issues is not None:
+                    build.failed_tests.append(row[6])
+                    build.failed_issues.append(row[7])
+        for builder in builders:
+            builder.add(*saved_builds[str(builder)])
+        return saved_builds
 
     def get_builds(self, n, *builds):
         """Yield the last n builds.
@@ -291,28 +750,57 @@ class Builder(object):
             if num == 0:
                 return
 
+    def refresh(self, n, *builds):
+        """Add the new builds, and return the last n builds.
+
+        Only the XMLRPC build tuples which are new, or which were building,
+        are retrieved.  The older builds are forgotten.
+        """
+        for build_info in builds:
+            num = build_info[1]
+            known = self.builds.get(num)
+            if (known.result == S_BUILDING if known is not None
+                    else num > self.lastbuild):
+                self.add(Build(*build_info))
+        nums = sorted(self.builds, reverse=True)
+        for num in nums[n:]:
+            del self.builds[num]
+        return [self.builds[num] for num in nums[:n]]
+
     def get_saved_builds(self, n):
         """Retrieve the last n builds from the local cache."""
-        if conn is None:
-            return []
-        cur = conn.execute('SELECT build FROM builds WHERE builder = ? '
-                           'ORDER BY build DESC LIMIT ?', (self.name, n))
-        builds = [Build(self.name, num) for (num,) in cur.fetchall()]
-        self.add(*builds)
+        return self.query_saved_builds([self], n)[self.name]
+
+    def restore(self, n):
+        """Forget the retrieved builds, and return the last n saved builds.
+
+        The builds which are not saved will be retrieved again.
+        """
+        self.builds.clear()
+        builds = self.get_saved_builds(n)
+        self.lastbuild = max([build.num for build in builds] or [0])
         return builds
 
+    @property
+    def url(self):
+        """The builder URL."""
+        return baseurl + 'builders/' + urllib.quote(self.name)
+
     def __eq__(self, other):
         return str(self) == str(other)
 
     def __str__(self):
         return self.name
 
-    def _load_builder(self):
+    def _load_builder(self, row=None):
         """Populate the builder attributes from the local cache."""
         if conn is None:
             return
-        row = conn.execute('SELECT lastbuild, status FROM builders WHERE '
-                           'builder = ? ', (self.name,)).fetchone()
+        if row is None:
+            if self.name in unit_of_work.builders:
+                unit_of_work.flush()
+            row = conn.execute('SELECT lastbuild, status FROM builders '
+                               'WHERE builder = ? ', (self.name,)).fetchone()
         if row is not None:
             self.saved = True
             (self.lastbuild, self.status) = row
@@ -328,7 +816,6 @@ class Builder(object):
             last = max(last, build.num)
         if last > self.lastbuild:
             self.lastbuild = last
-            self.remove_oldest()
             self.save()
 
     def set_status(self, status):
@@ -336,33 +823,12 @@ class Builder(object):
         self.status = status
         self.save()
 
-    def remove_oldest(self):
-        global removed_builds
-        if conn is None:
-            return
-        if CACHE_BUILDS <= 0:
-            return
-        # Remove obsolete data
-        minbuild = self.lastbuild - CACHE_BUILDS
-        cur = conn.execute('DELETE FROM builds WHERE builder = ? AND '
-                           'build < ?', (self.name, minbuild))
-        if cur.rowcount:
-            removed_builds += cur.rowcount
-
     def save(self):
         """Insert or update the builder in the local cache."""
         if conn is None:
             return
-        if self.saved:
-            conn.execute('UPDATE builders SET lastbuild = ?, status = ? '
-                         'WHERE builder = ?',
-                         (self.lastbuild, self.status, self.name))
-        else:
-            conn.execute('INSERT INTO builders(builder, host, branch, '
-                         'lastbuild, status) VALUES (?, ?, ?, ?, ?)',
-                         (self.name, self.host, self.branch,
-                          self.lastbuild, self.status))
-            self.saved = True
+        unit_of_work.add_builder(self)
+        self.saved = True
         return True
 
 
@@ -372,19 +838,43 @@ class Build(object):
     Build.result should be one of (S_SUCCESS, S_FAILURE, S_EXCEPTION).
     If the result is not available, it defaults to S_BUILDING.
     """
-    _message = saved = result = None
-    revision = 0
+
+    __slots__ = ('builder', 'num', 'revision', 'result', '_message',
+                 'saved', 'timestamp', 'failed_tests',
+                 # Issue of each failed test, for the rules with this digest
+                 'rules_digest', 'failed_issues')
 
     def __init__(self, name, buildnum, *args):
         self.builder = name
         self.num = buildnum
-        self._url = '%s/builders/%s/builds/' % (baseurl, urllib.quote(name))
+        self._message = self.saved = self.result = self.timestamp = None
+        self.revision = 0
+        self.rules_digest = self.failed_issues = None
         self._get_build(args)
         self.failed_tests = []
         if self.result not in (S_SUCCESS, S_BUILDING):
             self._get_failures()
         self.save()
 
+    @classmethod
+    def from_cache(cls, row):
+        """Create a build from a row of the local cache, without query.
+
+        The failed tests and their issues are added by the caller.
+        """
+        self = cls.__new__(cls)
+        (self.builder, self.num, self.revision, result,
+         self._message, self.rules_digest) = row
+        self.result = result
+        self.saved = True
+        self.timestamp = None
+        self.failed_tests = []
+        if result not in (S_SUCCESS, S_BUILDING):
+            self.failed_issues = []
+        else:
+            self.failed_issues = None
+        return self
+
     @property
     def id(self):
         """The build identifier."""
@@ -393,7 +883,9 @@ class Build(object):
     @property
     def url(self):
         """The build URL."""
-        return self._url + str(self.num)
+        return '%s/builders/%s/builds/%s' % (baseurl,
+                                             urllib.quote(self.builder),
+                                             self.num)
 
     def _get_build(self, args):
         # Load the build data from the cache, or online
@@ -405,6 +897,7 @@ class Build(object):
         if args:
             # Use the XMLRPC response
             assert len(args) == 7
+            self.timestamp = args[1]
             revision, result = args[3:5]
             if result in (S_EXCEPTION, S_FAILURE):
                 # Store the failure details
@@ -420,11 +913,15 @@ class Build(object):
 
     def _get_failures(self):
         # Load the failures from the cache, or parse the stdio log
+        if stats is not None:
+            stats.add_cache('failures', self.saved and conn is not None)
         if self.saved and conn is not None:
-            cur = conn.execute('SELECT failed FROM failures WHERE '
+            cur = conn.execute('SELECT failed, issue FROM failures WHERE '
                                'builder = ? AND build = ?',
                                (self.builder, self.num))
-            self.failed_tests = [test for (test,) in cur.fetchall()]
+            rows = cur.fetchall()
+            self.failed_tests = [test for (test, issue) in rows]
+            self.failed_issues = [issue for (test, issue) in rows]
         else:
             if self._message is None or 'test' in self._message:
                 # Parse stdio on demand
@@ -436,14 +933,10 @@ class Build(object):
             return
         if self.result not in (S_SUCCESS, S_FAILURE, S_EXCEPTION):
             return False
-        conn.execute('INSERT INTO builds(builder, build, revision, result, '
-                     'message) VALUES (?, ?, ?, ?, ?)', (self.builder,
-                     self.num, self.revision, self.result, self._message))
-        if self.failed_tests:
-            rows = ((self.builder, self.num, test)
-                    for test in self.failed_tests)
-            conn.executemany('INSERT INTO failures(builder, build, failed) '
-                             'VALUES (?, ?, ?)', rows)
+        if deadline_expired():
+            # The failures may be incomplete
+            return False
+        unit_of_work.add_build(self)
         self.saved = True
         return True
 
@@ -451,18 +944,62 @@ class Build(object):
         # Load revision, result and message from the local cache
         result = None
         if conn is not None and self.num >= 0:
-            row = conn.execute('SELECT revision, result, message FROM builds'
-                               ' WHERE builder = ? AND build = ?',
+            if (self.builder, self.num) in unit_of_work.builds:
+                unit_of_work.flush()
+            row = conn.execute('SELECT revision, result, message, '
+                               'rules_digest FROM builds WHERE builder = ? '
+                               'AND build = ?',
                                (self.builder, self.num)).fetchone()
+            if stats is not None:
+                stats.add_cache('builds', row is not None)
             if row is not None:
                 self.saved = True
-                (self.revision, result, self._message) = row
+                (self.revision, result, self._message,
+                 self.rules_digest) = row
         return result
 
+    def set_issues(self, rules_digest, failed_issues):
+        """Store the issue of each failed test, or None if it is new."""
+        self.rules_digest = rules_digest
+        self.failed_issues = failed_issues
+        if conn is None or not self.saved:
+            return
+        if (self.builder, self.num) in unit_of_work.builds:
+            # Not inserted yet
+            return
+        conn.execute('UPDATE builds SET rules_digest = ? WHERE builder = ? '
+                     'AND build = ?', (rules_digest, self.builder, self.num))
+        rows = ((issue, self.builder, self.num, test)
+                for (test, issue) in zip(self.failed_tests, failed_issues))
+        conn.executemany('UPDATE failures SET issue = ? WHERE builder = ? '
+                         'AND build = ? AND failed = ?', rows)
+
     def _parse_build(self):
         # Retrieve num, result, revision and message from the server
-        build_page = urlread(self.url)
-        if not build_page:
+        if stats is None:
+            return self._parse_build_page()
+        start = time.time()
+        try:
+            return self._parse_build_page()
+        finally:
+            stats.add_time('build pages', time.time() - start)
+
+    def _parse_build_page(self):
+        host = parse_builder_name(self.builder)[0]
+        skip = negative_cache.skip(self.builder, self.num, host)
+        if stats is not None:
+            stats.add_cache('build pages', skip)
+        if skip:
+            return S_BUILDING
+        try:
+            status, headers, build_page = http_pool.request('GET', self.url)
+        except (IOError, httplib.HTTPException):
+            # Back off only when the host is unreachable
+            if not deadline_expired():
+                negative_cache.host_failed(host)
+            return S_BUILDING
+        negative_cache.host_reached(host)
+        if status != httplib.OK or not build_page:
             return S_BUILDING
         match = RE_BUILD.search(build_page)
         if match:
@@ -471,6 +1008,7 @@ class Build(object):
             self._message = u(match.group(3))
         else:
             result = S_BUILDING
+            negative_cache.add_build(self.builder, self.num)
         match = RE_BUILD_REVISION.search(build_page)
         if match:
             self.revision = int(match.group(1))
@@ -479,60 +1017,62 @@ class Build(object):
 
     def _parse_stdio(self):
         # Lookup failures in the stdio log on the server
-        stdio = urlread(self.url + '/steps/test/logs/stdio')
-        stdio = stdio.replace(HTMLNOISE, b(''))
-
-        # Check if some test failed
-        fail = RE_FAILED.search(stdio)
-        if fail:
-            failed_count = int(fail.group(1))
-            failed_tests = u(fail.group(2).strip())
-            self.failed_tests = failed_tests.split()
-            assert len(self.failed_tests) == failed_count
-
-        lines = stdio.splitlines()
-
-        # Check if disk full or out of memory
-        for line in lines:
-            error = next((e for e in OSERRORS if e in line), None)
-            if error is None:
-                continue
-            self.result = S_EXCEPTION
-            self._message = u(error.lower())
-            break
-        else:
-            self._message = error = ''
-
-        if fail or error:
-            # If something is found, stop here
-            return
-
-        self._message = 'something crashed'
-        reversed_lines = reversed(lines)
-        for line in reversed_lines:
-            killed = RE_BBTEST.search(line) or RE_STOP.search(line)
-            if killed:
-                self._message = u(killed.group(1).strip().lower())
-                # Check previous line for a possible timeout
-                line = next(reversed_lines)
-
-            timeout = RE_TIMEOUT.search(line)
-            if timeout:
-                minutes = int(timeout.group(1)) // 60
-                # It is a test failure
-                self.result = S_FAILURE
-                self._message = 'hung for %d min' % minutes
-                # Move to previous line
-                line = next(reversed_lines)
-
-            failed = RE_TEST.match(line)
-            if failed:
-                # This is the last running test
-                self.failed_tests = [u(failed.group(1))]
-                break
-        else:
-            # No test failure: probably a buildbot error
-            self.result = S_EXCEPTION
+        if stats is None:
+            return self._parse_stdio_log()
+        start = time.time()
+        try:
+            self._parse_stdio_log()
+        finally:
+            stats.add_time('stdio logs', time.time() - start)
+
+    def _parse_stdio_log(self):
+        url = self.url + '/steps/test/logs/stdio'
+        keep = log_store.enabled() and self.num >= 0
+        parser = None
+        if STDIO_RANGE > 0 and not keep:
+            # Try with the end of the log first, unless the whole log
+            # is stored for --reparse
+            parser = self._parse_stdio_tail(url)
+        if parser is None:
+            parser = stdio_parser(keep)
+            urlread(url, parser.feed)
+        if keep and parser.chunks:
+            log_store.add(self.builder, self.num, b('').join(parser.chunks),
+                          self.result)
+        self._set_stdio_results(*parser.close())
+
+    def _set_stdio_results(self, failed_tests, result, message):
+        self._message = message
+        if failed_tests is not None:
+            self.failed_tests = failed_tests
+        if result is not None:
+            self.result = result
+
+    def _parse_stdio_tail(self, url):
+        # Return the parser, or None if the end of the log is not enough
+        parser = stdio_parser()
+        headers = {'Range': 'bytes=-%d' % STDIO_RANGE}
+        try:
+            (status, headers, data) = http_pool.request(
+                'GET', url, headers=headers, consume=parser.feed)
+        except (IOError, httplib.HTTPException):
+            return None
+        if status == httplib.OK:
+            # The server sent the whole log
+            return parser
+        if status != httplib.PARTIAL_CONTENT:
+            return None
+        if headers.get('content-range', '').startswith('bytes 0-'):
+            # The whole log is in the range
+            parser.feed(data)
+            return parser
+        # Skip the first line, which is truncated
+        parser.feed(data[data.find(b('\n')) + 1:])
+        # Without the failed tests, the build may have crashed after an
+        # OS error, before the tail
+        if not parser.has_verdict():
+            return None
+        return parser
 
     def get_message(self, length=2048):
         """Return the build result including failed test as a string."""
@@ -558,6 +1098,286 @@ class Build(object):
         return SYMBOL[self.result] + ' ' + msg
 
 
+class StdioParser(object):
+    """Parse the stdio log of the test step, chunk by chunk.
+
+    Each chunk is scanned once, with string methods and regular
+    expressions which run in linear time: the Python code runs only for
+    the lines which follow the failed tests header.  Only the end of the
+    log is kept in memory, up to STDIO_TAIL bytes, and the end of a
+    longer line.
+    """
+    _failed_count = _failed_lines = failed_tests = error = _last_test = None
+
+    def __init__(self, keep=False):
+        # The pieces of the last line, not terminated yet
+        self._partial = []
+        self._partial_size = 0
+        self._tail = b('')
+        # The OS errors in the cut start of the pending line
+        self._line_errors = set()
+        # All the chunks, if the log is kept
+        self.chunks = [] if keep else None
+
+    def feed(self, data):
+        """Parse a chunk of the log."""
+        if self.chunks is not None:
+            self.chunks.append(data)
+        # Search the end of the lines in the new data only; a "\r" at the
+        # end may be followed by "\n"
+        end = max(data.rfind(b('\n')), data.rfind(b('\r'), 0, -1)) + 1
+        if end:
+            self._partial.append(data[:end])
+            self._scan(b('').join(self._partial))
+            data = data[end:]
+            self._partial = []
+            self._partial_size = 0
+        if data:
+            self._partial.append(data)
+            self._partial_size += len(data)
+            if self._partial_size > 2 * STDIO_TAIL:
+                self._cut_partial()
+
+    def _cut_partial(self):
+        # Keep the end of a very long line, and remember its OS errors.
+        # The kept end does not match at the start of a line.
+        partial = b('').join(self._partial)
+        cut = len(partial) - STDIO_TAIL
+        if self.error is None:
+            longest = max([len(error) for error in OSERRORS])
+            head = partial[:cut + longest - 1].replace(HTMLNOISE, b(''))
+            self._line_errors.update([idx for (idx, error)
+                                      in enumerate(OSERRORS)
+                                      if error in head])
+        self._partial = [b('.'), partial[cut:]]
+        self._partial_size = STDIO_TAIL + 1
+
+    def _scan(self, block):
+        # Scan complete lines, each one terminated by a newline
+        block = block.replace(HTMLNOISE, b(''))
+        block = block.replace(b('\r\n'), b('\n')).replace(b('\r'), b('\n'))
+        if self.failed_tests is None:
+            block = self._scan_failed(block)
+
+        # Check if disk full or out of memory, on the first line
+        if self.error is None:
+            found = [(block.rfind(b('\n'), 0, pos), idx)
+                     for (idx, pos) in enumerate([block.find(error)
+                                                  for error in OSERRORS])
+                     if pos >= 0]
+            # The cut start of the first line
+            found.extend([(-1, idx) for idx in self._line_errors])
+            if found:
+                self.error = OSERRORS[min(found)[1]]
+        self._line_errors.clear()
+
+        # Keep the last lines
+        tail = self._tail + block
+        if len(tail) > STDIO_TAIL:
+            cut = tail.find(b('\n'), len(tail) - STDIO_TAIL - 1) + 1
+            if cut == len(tail):
+                # Keep the last line, at least
+                cut = tail.rfind(b('\n'), 0, -1) + 1
+            if self.failed_tests is None and self.error is None:
+                last_test = RE_LAST_TEST.match(tail, 0, cut)
+                if last_test is not None:
+                    self._last_test = last_test.group(1)
+            tail = tail[cut:]
+        self._tail = tail
+
+    def _scan_failed(self, block):
+        # Find the failed tests header, and collect the next indented lines;
+        # return the block without the headers
+        pieces = []
+        pos = start = 0
+        while self.failed_tests is None and pos < len(block):
+            if self._failed_lines is not None:
+                end = block.find(b('\n'), pos)
+                line = block[pos:end]
+                if line[:1] == b(' ') and len(line) > 1:
+                    self._failed_lines.append(line)
+                    pos = end + 1
+                    continue
+                self._end_failed()
+                if self.failed_tests is not None:
+                    break
+                # The header may be on this line
+            fail = RE_FAILED_END.search(block, pos)
+            if fail is None:
+                break
+            end = fail.start()
+            if not block[end - 1:end].isdigit():
+                # The header is "(\d+) tests? failed:", this is not one
+                pos = fail.end()
+                continue
+            line_start = block.rfind(b('\n'), 0, end) + 1
+            if not line_start:
+                # The cut start of the first line is before the header
+                self._line_errors.clear()
+            line = block[line_start:end]
+            count = line[len(line.rstrip(DIGITS)):]
+            end = block.find(b('\n'), fail.end())
+            rest = block[fail.end():end]
+            # Only the first header of a line is considered
+            pos = end + 1
+            self._failed_count = count
+            pieces.append(block[start:line_start])
+            start = fail.end()
+            if not rest:
+                self._failed_lines = []
+            elif rest[:1] == b(' ') and len(rest) > 1:
+                self._failed_lines = [rest]
+        if pieces:
+            pieces.append(block[start:])
+            block = b('').join(pieces)
+        return block
+
+    def flush(self):
+        """Parse the last line, even if it is incomplete."""
+        if self._partial:
+            self._partial.append(b('\n'))
+            self._scan(b('').join(self._partial))
+            self._partial = []
+            self._partial_size = 0
+
+    def has_verdict(self):
+        """Check if the failed tests or an error are found."""
+        self.flush()
+        if self._failed_lines:
+            return True
+        return self.failed_tests is not None or self.error is not None
+
+    def _end_failed(self):
+        if self._failed_lines:
+            failed_tests = u(b('\n').join(self._failed_lines))
+            self.failed_tests = failed_tests.split()
+            # Compare the digits, which can be too many for int()
+            assert (b(str(len(self.failed_tests))) ==
+                    (self._failed_count.lstrip(b('0')) or b('0')))
+        self._failed_lines = None
+
+    def close(self):
+        """Return the failed tests, the result and the message.
+
+        The failed tests and the result are None if they are unchanged.
+        """
+        self.flush()
+        if self._failed_lines is not None:
+            self._end_failed()
+
+        if self.error is not None:
+            return self.failed_tests, S_EXCEPTION, u(self.error.lower())
+        if self.failed_tests is not None:
+            # If something is found, stop here
+            return self.failed_tests, None, ''
+
+        result = None
+        message = 'something crashed'
+        reversed_lines = reversed(self._tail.split(b('\n'))[:-1])
+        for line in reversed_lines:
+            killed = RE_BBTEST.search(line) or RE_STOP.search(line)
+            if killed:
+                message = u(killed.group(1).strip().lower())
+                # Check previous line for a possible timeout
+                line = next(reversed_lines, b(''))
+
+            timeout = RE_TIMEOUT.search(line)
+            if timeout:
+                minutes = int(timeout.group(1)) // 60
+                # It is a test failure
+                result = S_FAILURE
+                message = 'hung for %d min' % minutes
+                # Move to previous line
+                line = next(reversed_lines, b(''))
+
+            failed = RE_TEST.match(line)
+            if failed:
+                # This is the last running test
+                return [u(failed.group(1))], result, message
+        if self._last_test is not None:
+            # The last running test is before the tail
+            return [u(self._last_test)], result, message
+        # No test failure: probably a buildbot error
+        return None, S_EXCEPTION, message
+
+
+class PooledParser(object):
+    """Parse the stdio log in the process pool (option --processes).
+
+    The chunks are buffered, and the whole log is parsed by StdioParser
+    in a child process.  Only the results are sent back.
+    """
+
+    def __init__(self, keep=False):
+        self.chunks = []
+        self._results = None
+
+    def feed(self, data):
+        """Buffer a chunk of the log."""
+        self.chunks.append(data)
+        self._results = None
+
+    def _parse(self):
+        if self._results is None:
+            self._results = parse_pool.apply(parse_stdio,
+                                             (b('').join(self.chunks),))
+        return self._results
+
+    def has_verdict(self):
+        """Check if the failed tests or an error are found."""
+        return self._parse()[0]
+
+    def close(self):
+        """Return the failed tests, the result and the message."""
+        return self._parse()[1]
+
+
+def stdio_parser(keep=False):
+    """Return a parser for the stdio log, in the process pool if any."""
+    if parse_pool is not None:
+        return PooledParser(keep)
+    return StdioParser(keep)
+
+
+def parse_stdio(data):
+    """Parse a whole stdio log, and return the verdict and the results.
+
+    It runs in the child processes of the pool too.
+    """
+    parser = StdioParser()
+    parser.feed(data)
+    return parser.has_verdict(), parser.close()
+
+
+def map_stdio(logs):
+    """Parse the stdio logs, in the process pool if any."""
+    if parse_pool is not None:
+        return parse_pool.map(parse_stdio, logs)
+    return [parse_stdio(data) for data in logs]
+
+
+def _init_parse_worker(stdio_tail):
+    # Configure the child process, which ignores Ctrl-C
+    global STDIO_TAIL
+    STDIO_TAIL = stdio_tail
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def start_parse_pool(processes):
+    """Start the processes which parse the stdio logs."""
+    global parse_pool
+    parse_pool = multiprocessing.Pool(processes, _init_parse_worker,
+                                      (STDIO_TAIL,))
+
+
+def stop_parse_pool():
+    global parse_pool
+    if parse_pool is not None:
+        parse_pool.close()
+        parse_pool.join()
+        parse_pool = None
+
+
 # ~~ Issues ~~
 
 
@@ -577,6 +1397,7 @@ class Rule(tuple):
         self.test_re = re.compile(test)
         self.message_re = re.compile(message)
         self.builder_re = re.compile(builder)
+        self.patterns = (self.test_re, self.message_re, self.builder_re)
 
     def match(self, test, message, builder):
         """Check if the failure attributes match the issue criteria."""
@@ -585,6 +1406,83 @@ class Rule(tuple):
                     self.builder_re.match(builder)))
 
 
+class RuleMatcher(object):
+    """Find the first issue which matches a failure.
+
+    The rules for an exact test name are indexed in a dictionary.
+    The other rules are grouped by their first non-empty pattern, and
+    these patterns are combined in alternations, to discard quickly the
+    groups which do not match.
+    """
+
+    def __init__(self, issues):
+        self.by_test = {}
+        self.groups = []
+        generic = ([], [], [])
+        position = 0
+        for number, issue in issues.items():
+            for rule in issue.rules:
+                entry = (position, number, rule)
+                position += 1
+                test = rule[0]
+                if test.endswith('$'):
+                    test = test[:-1]
+                if RE_TEST_NAME.match(test):
+                    self.by_test.setdefault(test, []).append(entry)
+                else:
+                    # Index of the first non-empty pattern
+                    field = next(idx for idx in range(3) if rule[idx])
+                    generic[field].append(entry)
+        for field, entries in enumerate(generic):
+            # The groups of a pattern are renumbered in an alternation,
+            # and its back-references would be wrong: check it alone
+            for entry in entries:
+                if entry[2].patterns[field].groups:
+                    self.groups.append((field, None, [entry]))
+            entries = [entry for entry in entries
+                       if not entry[2].patterns[field].groups]
+            for idx in range(0, len(entries), MATCHER_GROUP):
+                group = entries[idx:idx + MATCHER_GROUP]
+                patterns = ['(?:%s)' % rule.patterns[field].pattern
+                            for (position, number, rule) in group]
+                try:
+                    pattern = re.compile('|'.join(patterns))
+                except (re.error, AssertionError, OverflowError):
+                    # Too many groups, or incompatible patterns
+                    pattern = None
+                self.groups.append((field, pattern, group))
+
+    def match(self, test, message, builder):
+        """Return the number of the first issue which matches, or None."""
+        event = (test, message, builder)
+        candidates = list(self.by_test.get(test, ()))
+        for (field, pattern, group) in self.groups:
+            if pattern is None or pattern.match(event[field]):
+                candidates.extend(group)
+        for (position, number, rule) in sorted(candidates):
+            if rule.match(test, message, builder):
+                return number
+        return None
+
+
+class BuildRef(tuple):
+    """Compact reference to a build, for the issue events."""
+
+    __slots__ = ()
+
+    def __new__(cls, build):
+        return tuple.__new__(cls, (build.builder, build.num, build.revision))
+
+    builder = property(operator.itemgetter(0))
+    num = property(operator.itemgetter(1))
+    revision = property(operator.itemgetter(2))
+
+    @property
+    def id(self):
+        """The build identifier."""
+        return getattr(self, BUILD_ID)
+
+
 class MatchIssue(object):
     """Represent an issue from the issue tracker."""
 
@@ -611,13 +1509,6 @@ class MatchIssue(object):
         if rule not in self.rules:
             self.rules.append(rule)
 
-    def match(self, build, *event):
-        """Check if the failure attributes match any issue criteria."""
-        rv = any(rule.match(*event) for rule in self.rules)
-        if rv:
-            self.events.setdefault(event, []).append(build)
-        return rv
-
 
 class Issues(dict, MutableMapping):
     """Ordered dictionary of issues from the issue tracker."""
@@ -625,12 +1516,16 @@ class Issues(dict, MutableMapping):
     def __init__(self, *args, **kw):
         self.__keys = []
         self._preload = []
+        self._matcher = self._digest = None
+        # The builds already matched, to record their events once
+        self._matched = set()
         self.new_events = {}
         self.update(*args, **kw)
         # By default do not record
         self.__record = False
 
     def __setitem__(self, key, value):
+        self._matcher = self._digest = None
         if key in self:
             self[key].add(value)
         else:
@@ -653,8 +1548,17 @@ class Issues(dict, MutableMapping):
         """Return the issues by number of events descending."""
         return sorted(dict.values(self), key=lambda m: -len(m.events))
 
+    def reset_events(self):
+        """Forget the events, before a new report."""
+        self._matched.clear()
+        self.new_events.clear()
+        for issue in dict.values(self):
+            issue.events.clear()
+
     def clear(self, record=True):
+        self._matcher = self._digest = None
         del self.__keys[:]
+        self._matched.clear()
         self.new_events.clear()
         dict.clear(self)
         if conn is not None:
@@ -665,12 +1569,12 @@ class Issues(dict, MutableMapping):
     def load(self, offline=False):
         """Populate the issues."""
         if not offline:
-            page = urlread(issuesurl)
+            page = self._download()
             if page:
                 # Reset the table
                 self.clear()
             else:
-                # If page is empty, use cache
+                # If page is empty or not modified, use cache
                 offline = True
         if offline:
             # Load the cache first
@@ -684,6 +1588,42 @@ class Issues(dict, MutableMapping):
             # Load online issues
             self._load_from_page(u(page))
 
+    def _download(self):
+        """Download the page, unless it is not modified since last time.
+
+        The ETag and the Last-Modified date of the page are sent with the
+        request, if the cached rules were created with the same local
+        configuration.  If the content did not change, the page is
+        ignored too.
+        """
+        preload = hashlib.sha1(b(repr(self._preload))).hexdigest()
+        headers = {}
+        cached = preload == get_metadata('issues_preload')
+        if cached:
+            etag = get_metadata('issues_etag')
+            last_modified = get_metadata('issues_last_modified')
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        try:
+            (status, rheaders, page) = http_pool.request('GET', issuesurl,
+                                                         headers=headers)
+        except (IOError, httplib.HTTPException):
+            return b('')
+        if status == httplib.NOT_MODIFIED and cached:
+            return b('')
+        if status != httplib.OK:
+            return b('')
+        digest = hashlib.sha1(page).hexdigest()
+        if cached and digest == get_metadata('issues_hash'):
+            page = b('')
+        set_metadata('issues_etag', rheaders.get('etag'))
+        set_metadata('issues_last_modified', rheaders.get('last-modified'))
+        set_metadata('issues_hash', digest)
+        set_metadata('issues_preload', preload)
+        return page
+
     def _load_from_cache(self):
         """Load the issues from the local cache."""
         if conn is None:
@@ -710,22 +1650,52 @@ class Issues(dict, MutableMapping):
             if rule[0][0] != '*':
                 self[rule[0]] = rule[1:4]
 
+    @property
+    def digest(self):
+        """The digest of the rules, in order."""
+        if self._digest is None:
+            rules = ['%s:%s:%s:%s' % ((number,) + rule)
+                     for number, issue in self.items()
+                     for rule in issue.rules]
+            self._digest = hashlib.sha1(b('\n'.join(rules))).hexdigest()
+        return self._digest
+
     def match(self, build):
+        """Return the new and the known failures of the build.
+
+        The issues are stored on the build, and in the cache, for the
+        current rules.
+        """
         msg = build._message
         builder = build.builder
+        if build.rules_digest != self.digest:
+            if stats is not None:
+                start = time.time()
+            if self._matcher is None:
+                self._matcher = RuleMatcher(self)
+            build.set_issues(self.digest,
+                             [self._matcher.match(test, msg, builder)
+                              for test in build.failed_tests])
+            if stats is not None:
+                stats.add_time('issue matching', time.time() - start)
+        key = (builder, build.num)
+        record = key not in self._matched
+        self._matched.add(key)
         known = []
         new = []
         new_events = self.new_events
-        for test in build.failed_tests:
+        for test, issue in zip(build.failed_tests, build.failed_issues):
             event = (test, msg, builder)
-            issue = next((number for number, issue in self.items()
-                          if issue.match(build, test, msg, builder)), False)
-            if issue:
+            if issue is not None:
+                if record:
+                    events = self[issue].events
+                    events.setdefault(event, []).append(BuildRef(build))
                 test += '`%s' % issue
                 known.append(test)
             else:
                 new.append(test)
-                new_events.setdefault(event, []).append(build)
+                if record:
+                    new_events.setdefault(event, []).append(BuildRef(build))
         return new, known
 
     def new_failures(self, verbose=False):
@@ -763,6 +1733,14 @@ class AbstractOutput(object):
 
     def __init__(self, options):
         self.options = options
+        self.stale = []
+
+    def add_stale(self, name):
+        """Flag a builder whose builds are read from the local cache.
+
+        It is called before add_builds, when the deadline is exceeded.
+        """
+        self.stale.append(name)
 
     def add_builds(self, name, builds):
         """Add builds for a builder.
@@ -776,6 +1754,12 @@ class AbstractOutput(object):
         """
         pass
 
+    def print_stale(self):
+        """Print the builders which are not up to date."""
+        if self.stale:
+            out(cformat('Stale:', S_OFFLINE), '%d builder(s) (deadline '
+                'exceeded), %s' % (len(self.stale), ', '.join(self.stale)))
+
     def display(self):
         """Display result.
 
@@ -853,8 +1837,10 @@ class BuilderOutput(AbstractOutput):
         else:
             builder_status = S_SUCCESS
 
+        # Flag the builds which are read from the local cache
+        stale = [cformat('(stale)', S_OFFLINE)] if name in self.stale else []
         out(cformat('%-26s' % name, builder_status), ', '.join(capsule),
-            end=' ')
+            *stale, end=' ')
 
         if quiet and failed_builds:
             # Print last failure or error.
@@ -890,6 +1876,7 @@ class BuilderOutput(AbstractOutput):
 
         # Show the summary at the bottom
         out('Totals:', ' + '.join(totals))
+        self.print_stale()
         out(issues.new_failures())
 
     def _group_by_status(self):
@@ -1013,6 +2000,7 @@ class RevisionOutput(AbstractOutput):
                 out()
             self.display_revisions(branch.revisions)
             empty_line = True
+        self.print_stale()
 
     def display_revisions(self, revisions):
         revisions = sorted(revisions.items())
@@ -1067,6 +2055,7 @@ class IssueOutput(AbstractOutput):
 
         # Broken builders
         self.print_broken_builders()
+        self.print_stale()
 
     def print_broken_builders(self):
         """Print broken and offline builders."""
@@ -1078,10 +2067,49 @@ class IssueOutput(AbstractOutput):
 
 
 class JsonOutput(IssueOutput):
-    """JSON output, subclass of IssueOutput."""
+    """JSON output, subclass of IssueOutput.
+
+    The report is written to the jsonfile, or published by the report
+    server with the --serve option.
+    """
+
+    def __init__(self, options):
+        IssueOutput.__init__(self, options)
+        self.builders = []
+
+    def add_builds(self, name, builds):
+        """Add builds for a builder."""
+        IssueOutput.add_builds(self, name, builds)
+        done = [build for build in builds
+                if build is not None and build.result != S_BUILDING]
+        count_success = len([build for build in done
+                             if build.result == S_SUCCESS])
+        if count_success == 0:
+            is_active = (builds[0] and builds[0].revision) or done
+            status = S_FAILURE if is_active else S_OFFLINE
+        elif count_success < len(done):
+            status = S_UNSTABLE
+        else:
+            status = S_SUCCESS
+        self.builders.append({
+            'builder': name,
+            'status': status,
+            'stale': name in self.stale,
+            'builds': [(b.num, b.revision, b.result)
+                       for b in builds if b is not None],
+        })
 
     def display(self):
         """Display result."""
+        report = self.get_report()
+        if report_server is not None:
+            report_server.publish(report)
+            return
+        with open(jsonfile, 'w') as f:
+            json.dump(report, f, indent=1, separators=(',', ': '))
+
+    def get_report(self):
+        """Return the report as a dictionary."""
 
         def format_failure(failure, builds):
             test, message, builder = failure
@@ -1120,52 +2148,791 @@ class JsonOutput(IssueOutput):
             'messages': builder['messages'],
         } for host, builder in sorted(self.broken.items())]
 
-        with open(jsonfile, 'w') as f:
-            json.dump({
-                'count_build': self.count_build,
-                'count_new': count_new,
-                'changed': datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC'),
-                'new': new,
-                'known': known,
-                'gone': gone,
-                'broken': broken,
-            }, f, indent=1, separators=(',', ': '))
+        return {
+            'count_build': self.count_build,
+            'count_new': count_new,
+            'changed': datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC'),
+            'new': new,
+            'known': known,
+            'gone': gone,
+            'broken': broken,
+            'builders': self.builders,
+        }
+
+
+class StatsOutput(AbstractOutput):
+    """Failure rates and flakiness of the builders and the tests.
+
+    The statistics are computed by the local cache, over all the cached
+    builds of the selected builders (see CACHE_BUILDS).
+    """
+
+    def __init__(self, options):
+        AbstractOutput.__init__(self, options)
+        out("... retrieving build results")
+        self.names = []
+
+    def add_builds(self, name, builds):
+        """Add a builder, once its builds are in the local cache."""
+        self.names.append(name)
+
+    def display(self):
+        """Display result."""
+        header = '%6s %6s %6s %5s %7s %7s' % ('builds', 'failed', 'rate',
+                                              'flips', 'first', 'last')
+        if not self.options.quiet:
+            out('%-26s %8s' % ('Builders:', ''), header)
+            for row in query_builder_stats(self.names):
+                (name, builds, failed) = row[:3]
+                if not failed:
+                    status = S_SUCCESS
+                elif failed < builds:
+                    status = S_UNSTABLE
+                else:
+                    status = S_FAILURE
+                out(cformat('%-26s' % name, status), '%8s' % '',
+                    self.format_counts(*row[1:]))
+            out()
+
+        rows = query_test_stats(self.names)
+        out('%-26s %8s' % ('Tests:', 'builders'), header)
+        shown = rows if self.options.verbose else rows[:MAX_FAILURES]
+        for (test, builders, builds, failed, flips, first, last) in shown:
+            status = S_UNSTABLE if flips > 1 else S_FAILURE
+            out(cformat('%-26s' % test, status), '%8d' % builders,
+                self.format_counts(builds, failed, flips, first, last))
+        if len(rows) > len(shown):
+            out('  and %d more failed tests' % (len(rows) - len(shown)))
+        self.print_stale()
+
+    def format_counts(self, builds, failed, flips, first, last):
+        return '%6d %6d %5.1f%% %5d %7s %7s' % (
+            builds, failed, 100. * failed / builds, flips or 0,
+            first or '-', last or '-')
 
 
 # ~~ Local cache ~~
 
 
+class UnitOfWork(object):
+    """Collect the changes to the local cache, and write them in batches.
+
+    The changes are flushed after each builder, or when FLUSH_THRESHOLD
+    objects are pending, and before reading a pending row.
+    """
+
+    def __init__(self):
+        self.builders = {}
+        self.builds = {}
+
+    def add_builder(self, builder):
+        """Insert or update the builder on the next flush."""
+        with dblock:
+            self.builders[builder.name] = builder
+            self._check_threshold()
+
+    def add_build(self, build):
+        """Insert the build and its failures on the next flush."""
+        with dblock:
+            self.builds[(build.builder, build.num)] = build
+            self._check_threshold()
+
+    def _check_threshold(self):
+        if len(self.builders) + len(self.builds) >= FLUSH_THRESHOLD:
+            self.flush()
+
+    def flush(self):
+        """Write the pending changes."""
+        with dblock:
+            (builders, builds) = (self.builders, self.builds)
+            if conn is None or not (builders or builds):
+                return
+            self.builders = {}
+            self.builds = {}
+            conn.executemany(
+                'INSERT OR REPLACE INTO builders(builder, host, branch, '
+                'lastbuild, status) VALUES (?, ?, ?, ?, ?)',
+                [(builder.name, builder.host, builder.branch,
+                  builder.lastbuild, builder.status)
+                 for builder in builders.values()])
+            builds = [build for (key, build) in sorted(builds.items())]
+            conn.executemany(
+                'INSERT INTO builds(builder, build, revision, result, '
+                'message, timestamp, rules_digest) VALUES '
+                '(?, ?, ?, ?, ?, ?, ?)',
+                [(build.builder, build.num, build.revision, build.result,
+                  build._message, int(build.timestamp or time.time()),
+                  build.rules_digest) for build in builds])
+            rows = []
+            for build in builds:
+                failed_issues = (build.failed_issues or
+                                 [None] * len(build.failed_tests))
+                rows.extend((build.builder, build.num, test, issue)
+                            for (test, issue) in zip(build.failed_tests,
+                                                     failed_issues))
+            conn.executemany('INSERT INTO failures(builder, build, failed, '
+                             'issue) VALUES (?, ?, ?, ?)', rows)
+
+# Instanciate the global unit of work
+unit_of_work = UnitOfWork()
+
+
+class NegativeCache(object):
+    """Remember the builds in progress and the unreachable hosts.
+
+    The page of a build in progress is not retrieved again for BUILDING_TTL
+    seconds.  After a failure, the build pages of the host are not
+    retrieved for BACKOFF_MIN seconds, doubled after each new failure.
+    The entries are loaded on first use, and written on save.
+    """
+
+    def __init__(self):
+        self.builds = None
+        self.hosts = None
+        self.changed = False
+
+    def _load(self):
+        if self.builds is not None:
+            return
+        self.builds = {}
+        self.hosts = {}
+        if conn is None:
+            return
+        rows = conn.execute('SELECT builder, build, expires FROM '
+                            'pending_builds WHERE expires > ?',
+                            (time.time(),)).fetchall()
+        self.builds = dict(((builder, num), expires)
+                           for (builder, num, expires) in rows)
+        rows = conn.execute('SELECT host, failures, retry FROM hosts')
+        self.hosts = dict((host, (failures, retry))
+                          for (host, failures, retry) in rows.fetchall())
+
+    def skip(self, builder, num, host):
+        """Return True if the build page should not be retrieved now."""
+        with dblock:
+            self._load()
+            now = time.time()
+            return (self.builds.get((builder, num), 0) > now or
+                    self.hosts.get(host, (0, 0))[1] > now)
+
+    def add_build(self, builder, num):
+        """The build is in progress."""
+        with dblock:
+            self._load()
+            self.builds[(builder, num)] = time.time() + BUILDING_TTL
+            self.changed = True
+
+    def host_failed(self, host):
+        """The host is unreachable: back off."""
+        with dblock:
+            self._load()
+            failures = self.hosts.get(host, (0, 0))[0] + 1
+            delay = min(BACKOFF_MIN * 2 ** (failures - 1), BACKOFF_MAX)
+            self.hosts[host] = (failures, time.time() + delay)
+            self.changed = True
+
+    def host_reached(self, host):
+        with dblock:
+            self._load()
+            if self.hosts.pop(host, None) is not None:
+                self.changed = True
+
+    def save(self):
+        """Write the entries which did not expire."""
+        with dblock:
+            if conn is None or not self.changed:
+                return
+            now = time.time()
+            conn.execute('DELETE FROM pending_builds')
+            conn.executemany('INSERT INTO pending_builds(builder, build, '
+                             'expires) VALUES (?, ?, ?)',
+                             [key + (expires,) for (key, expires)
+                              in self.builds.items() if expires > now])
+            conn.execute('DELETE FROM hosts')
+            conn.executemany('INSERT INTO hosts(host, failures, retry) '
+                             'VALUES (?, ?, ?)',
+                             [(host,) + value
+                              for (host, value) in self.hosts.items()])
+            self.changed = False
+
+negative_cache = NegativeCache()
+
+
+class LogStore(object):
+    """Store of the compressed stdio logs, by content digest.
+
+    The identical logs are stored once, in the logdir.  The least
+    recently used logs are evicted above LOGSTORE_SIZE MB, and the logs
+    of the builds removed from the cache are evicted too.
+    """
+
+    def enabled(self):
+        return LOGSTORE_SIZE > 0 and conn is not None
+
+    def path(self, digest):
+        return os.path.join(logdir, digest[:2], digest + '.gz')
+
+    def add(self, builder, num, data, base_result):
+        """Store the log of the build, and its result before the parse."""
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # Created by another thread
+                    pass
+            # Write to a temporary file, to never read a truncated log
+            tmppath = '%s.%s.tmp' % (path, threading.current_thread().name)
+            with closing(gzip.open(tmppath, 'wb')) as f:
+                f.write(data)
+            os.rename(tmppath, path)
+        conn.execute('INSERT OR REPLACE INTO logs(builder, build, digest, '
+                     'size, accessed, base_result) VALUES (?, ?, ?, ?, ?, ?)',
+                     (builder, num, digest, os.path.getsize(path),
+                      time.time(), base_result))
+
+    def get(self, builder, num):
+        """Return the log of the build, or None."""
+        row = conn.execute('SELECT digest FROM logs WHERE builder = ? AND '
+                           'build = ?', (builder, num)).fetchone()
+        if row is None or not os.path.exists(self.path(row[0])):
+            return None
+        conn.execute('UPDATE logs SET accessed = ? WHERE builder = ? AND '
+                     'build = ?', (time.time(), builder, num))
+        with closing(gzip.open(self.path(row[0]), 'rb')) as f:
+            return f.read()
+
+    def evict(self):
+        """Remove the logs above the size limit, or without build."""
+        if conn is None:
+            return
+        # The digests of the cached builds, the most recently used first
+        rows = conn.execute('SELECT digest, MAX(size), MAX(accessed) FROM '
+                            'logs JOIN builds USING (builder, build) '
+                            'GROUP BY digest ORDER BY 3 DESC').fetchall()
+        keep = set()
+        total = 0
+        for (digest, size, accessed) in rows:
+            total += size
+            if total > LOGSTORE_SIZE * 1024 * 1024:
+                break
+            keep.add(digest)
+        rows = conn.execute('SELECT DISTINCT digest FROM logs').fetchall()
+        evicted = [(digest,) for (digest,) in rows if digest not in keep]
+        conn.executemany('DELETE FROM logs WHERE digest = ?', evicted)
+        for (digest,) in evicted:
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+
+log_store = LogStore()
+
+
+def reparse_logs():
+    """Parse again the stored logs of the cached builds, without network.
+
+    The failures, the result and the message of the builds are updated,
+    and their failures will be matched again with the known issues.
+    Return the number of builds reparsed, and changed.
+    """
+    unit_of_work.flush()
+    rows = conn.execute('SELECT builder, build, result, message, '
+                        'base_result FROM builds JOIN logs '
+                        'USING (builder, build) '
+                        'ORDER BY builder, build').fetchall()
+    changed = 0
+    # The logs are parsed by chunks, in the process pool if any
+    for idx in range(0, len(rows), REPARSE_CHUNK):
+        logs = [(row, log_store.get(*row[:2]))
+                for row in rows[idx:idx + REPARSE_CHUNK]]
+        logs = [(row, data) for (row, data) in logs if data is not None]
+        results = map_stdio([data for (row, data) in logs])
+        for ((row, data), (verdict, parse_results)) in zip(logs, results):
+            if _update_reparsed(row, parse_results):
+                changed += 1
+    return len(rows), changed
+
+
+def _update_reparsed(row, parse_results):
+    # Update the build with the results of its log, if they changed.
+    # The results are applied on the result of the build before the
+    # previous parse.
+    (builder, num, result, message, base_result) = row
+    build = Build.from_cache((builder, num, 0, base_result, message, None))
+    failed_tests = [test for (test,) in conn.execute(
+        'SELECT failed FROM failures WHERE builder = ? AND build = ?',
+        (builder, num)).fetchall()]
+    build._set_stdio_results(*parse_results)
+    if ((build.result, build._message, build.failed_tests) ==
+            (result, message, failed_tests)):
+        return False
+    conn.execute('UPDATE builds SET result = ?, message = ?, '
+                 'rules_digest = NULL WHERE builder = ? AND build = ?',
+                 (build.result, build._message, builder, num))
+    conn.execute('DELETE FROM failures WHERE builder = ? AND build = ?',
+                 (builder, num))
+    conn.executemany('INSERT INTO failures(builder, build, failed) '
+                     'VALUES (?, ?, ?)', [(builder, num, test)
+                                          for test in build.failed_tests])
+    return True
+
+# The database schema.  Append a new script to upgrade it.
+SCHEMA_MIGRATIONS = [
+    # Version 1: bbreport <= 0.1
+    """
+    CREATE TABLE IF NOT EXISTS builders(builder, host, branch, lastbuild,
+                                        status);
+    CREATE TABLE IF NOT EXISTS builds(builder, build, revision, result,
+                                      message);
+    CREATE TABLE IF NOT EXISTS failures(builder, build, failed);
+    CREATE TABLE IF NOT EXISTS rules(issue, test, message, builder)
+    """,
+    # Version 2: types, primary keys and indexes
+    """
+    ALTER TABLE builders RENAME TO old_builders;
+    ALTER TABLE builds RENAME TO old_builds;
+    ALTER TABLE failures RENAME TO old_failures;
+    ALTER TABLE rules RENAME TO old_rules;
+    CREATE TABLE builders(builder TEXT NOT NULL PRIMARY KEY,
+                          host TEXT, branch TEXT,
+                          lastbuild INTEGER NOT NULL DEFAULT 0,
+                          status TEXT);
+    CREATE TABLE builds(builder TEXT NOT NULL, build INTEGER NOT NULL,
+                        revision INTEGER, result TEXT, message TEXT,
+                        PRIMARY KEY (builder, build));
+    CREATE TABLE failures(builder TEXT NOT NULL, build INTEGER NOT NULL,
+                          failed TEXT NOT NULL);
+    CREATE INDEX failures_build ON failures(builder, build);
+    CREATE INDEX failures_failed ON failures(failed);
+    CREATE TABLE rules(issue TEXT NOT NULL, test TEXT, message TEXT,
+                       builder TEXT);
+    INSERT OR IGNORE INTO builders SELECT * FROM old_builders;
+    INSERT OR IGNORE INTO builds SELECT * FROM old_builds;
+    INSERT INTO failures SELECT * FROM old_failures;
+    INSERT INTO rules SELECT * FROM old_rules;
+    DROP TABLE old_builders;
+    DROP TABLE old_builds;
+    DROP TABLE old_failures;
+    DROP TABLE old_rules
+    """,
+    # Version 3: build timestamp, and delete the failures with the build
+    """
+    ALTER TABLE builds ADD COLUMN timestamp INTEGER;
+    UPDATE builds SET timestamp = CAST(strftime('%s', 'now') AS INTEGER);
+    DELETE FROM failures WHERE NOT EXISTS
+        (SELECT 1 FROM builds WHERE builds.builder = failures.builder
+                                AND builds.build = failures.build);
+    CREATE TRIGGER builds_delete AFTER DELETE ON builds BEGIN
+        DELETE FROM failures
+            WHERE builder = OLD.builder AND build = OLD.build;
+    END
+    """,
+    # Version 4: issue of the failures, with the digest of the rules
+    """
+    ALTER TABLE builds ADD COLUMN rules_digest TEXT;
+    ALTER TABLE failures ADD COLUMN issue TEXT
+    """,
+    # Version 5: validators of the known issues page, and other metadata
+    """
+    CREATE TABLE metadata(key TEXT NOT NULL PRIMARY KEY, value TEXT)
+    """,
+    # Version 6: builds in progress and unreachable hosts, for a while
+    """
+    CREATE TABLE pending_builds(builder TEXT NOT NULL,
+                                build INTEGER NOT NULL,
+                                expires REAL NOT NULL,
+                                PRIMARY KEY (builder, build));
+    CREATE TABLE hosts(host TEXT NOT NULL PRIMARY KEY,
+                       failures INTEGER NOT NULL, retry REAL NOT NULL)
+    """,
+    # Version 7: stdio logs of the builds, stored by content digest, and
+    # the result of the build before their parse
+    """
+    CREATE TABLE logs(builder TEXT NOT NULL, build INTEGER NOT NULL,
+                      digest TEXT NOT NULL, size INTEGER NOT NULL,
+                      accessed REAL NOT NULL, base_result TEXT,
+                      PRIMARY KEY (builder, build));
+    CREATE INDEX logs_digest ON logs(digest)
+    """,
+]
+
+
+
+class Rows(object):
+    """The rows returned by a query, already fetched."""
+
+    def __init__(self, rows, rowcount):
+        self.rows = rows
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class LockedConnection(object):
+    """Share the database connection between threads.
+
+    Each statement is executed and fetched while holding the dblock.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def execute(self, sql, parameters=()):
+        with dblock:
+            cur = self.connection.execute(sql, parameters)
+            return Rows(cur.fetchall(), cur.rowcount)
+
+    def executemany(self, sql, seq_of_parameters):
+        with dblock:
+            cur = self.connection.executemany(sql, list(seq_of_parameters))
+            return Rows([], cur.rowcount)
+
+
 def load_database():
     global conn
     if conn is None:
-        conn = sqlite3.connect(':memory:')
-    if os.path.exists(dbfile):
-        # Load the database in memory
-        with closing(gzip.open(dbfile, 'rb')) as f:
-            conn.executescript(u(f.read()))
+        dump = None
+        if os.path.exists(dbfile):
+            if is_dump(dbfile):
+                # The configured dbfile is a gzipped dump of bbreport <= 0.1
+                dump = dbfile + '.bak'
+                shutil.move(dbfile, dump)
+        elif os.path.exists(dumpfile):
+            dump = dumpfile
+        connection = sqlite3.connect(dbfile, check_same_thread=False)
+        # Write ahead log: only the changed pages are written
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        conn = LockedConnection(connection)
+        if dump is not None:
+            try:
+                load_dump(dump)
+            except Exception:
+                if dump != dumpfile:
+                    shutil.move(dump, dbfile)
+                raise
+            if dump == dumpfile:
+                shutil.move(dumpfile, dumpfile + '.bak')
     # Initialize or upgrade the tables
-    for table in ('builders(builder, host, branch, lastbuild, status)',
-                  'builds(builder, build, revision, result, message)',
-                  'failures(builder, build, failed)',
-                  'rules(issue, test, message, builder)'):
-        conn.execute('CREATE TABLE IF NOT EXISTS ' + table)
+    upgrade_database()
+
+
+def upgrade_database():
+    # Apply the missing migrations, each one in its own transaction
+    conn.execute('CREATE TABLE IF NOT EXISTS '
+                 'schema_version(version INTEGER NOT NULL)')
+    (version,) = conn.execute('SELECT MAX(version) FROM '
+                              'schema_version').fetchone()
+    version = version or 0
+    for script in SCHEMA_MIGRATIONS[version:]:
+        version += 1
+        conn.executescript('BEGIN; %s; INSERT INTO schema_version(version) '
+                           'VALUES (%d); COMMIT;' % (script, version))
+
+
+def is_dump(path):
+    # Check if the file is gzipped
+    try:
+        with closing(gzip.open(path, 'rb')) as f:
+            f.read(1)
+    except IOError:
+        return False
+    return True
+
+
+def load_dump(path):
+    # Migrate the gzipped SQL dump to the database file
+    try:
+        with closing(gzip.open(path, 'rb')) as f:
+            conn.executescript(u(f.read()))
+        conn.commit()
+    except Exception:
+        close_database()
+        os.remove(dbfile)
+        raise
 
 
 def prune_database():
-    if removed_builds:
-        out('Removed %s ancient builds' % removed_builds)
-        # Now purge the failures
-        conn.execute('DELETE FROM failures WHERE builder||":"||build '
-                     'NOT IN (SELECT builder||":"||build FROM builds)')
+    """Remove the builds which are not retained by any policy.
+
+    Return the number of builds and failures removed, and the bytes freed.
+    """
+    unit_of_work.flush()
+    # Each enabled policy retains some builds
+    retained = []
+    params = {}
+    if CACHE_BUILDS > 0:
+        retained.append('build >= (SELECT lastbuild FROM builders WHERE '
+                        'builders.builder = builds.builder) - :numbuilds')
+        params['numbuilds'] = CACHE_BUILDS
+    if CACHE_DAYS > 0:
+        retained.append('timestamp >= :mintime')
+        params['mintime'] = int(time.time()) - CACHE_DAYS * 86400
+    if not retained:
+        # No limit
+        return 0, 0, 0
+    if CACHE_LAST_FAILURE:
+        retained.append('build = (SELECT MAX(build) FROM builds AS last '
+                        'WHERE last.builder = builds.builder AND '
+                        'last.result <> :success)')
+        params['success'] = S_SUCCESS
+
+    (page_size,) = conn.execute('PRAGMA page_size').fetchone()
+    (free_pages,) = conn.execute('PRAGMA freelist_count').fetchone()
+    total_changes = conn.total_changes
+    # The failures are deleted by the trigger
+    removed = conn.execute('DELETE FROM builds WHERE NOT (%s)' %
+                           ' OR '.join(retained), params).rowcount
+    failures = conn.total_changes - total_changes - removed
+    (reclaimed,) = conn.execute('PRAGMA freelist_count').fetchone()
+    reclaimed = (reclaimed - free_pages) * page_size
+    if removed:
+        out('Removed %s ancient builds and %s failures (%d kB reclaimed)' %
+            (removed, failures, reclaimed // 1024))
+    return removed, failures, reclaimed
+
+
+def _select_builders(names):
+    # Fill the temporary table of the builders selected for the statistics
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS selected('
+                 'builder TEXT NOT NULL PRIMARY KEY)')
+    conn.execute('DELETE FROM selected')
+    conn.executemany('INSERT OR IGNORE INTO selected(builder) VALUES (?)',
+                     [(name,) for name in names])
+
+
+def _failing_id():
+    # The build identifier of the failing builds (option --id)
+    if BUILD_ID == 'num':
+        return 'b.build'
+    return 'NULLIF(b.revision, 0)'
+
+
+def query_builder_stats(names):
+    """Return the failure statistics of the builders, from the cache.
+
+    Each row is (builder, builds, failed, flips, first, last): the flips
+    are the changes between success and failure from a build to the next
+    one, and first and last are the identifiers of the failing builds.
+    """
+    unit_of_work.flush()
+    _select_builders(names)
+    return conn.execute(
+        'SELECT builder, COUNT(*), SUM(failed), SUM(failed <> prev_failed), '
+        'MIN(failing), MAX(failing) FROM ('
+        '  SELECT b.builder, b.result <> :success AS failed, '
+        '    CASE WHEN b.result <> :success THEN %s END AS failing, '
+        '    (SELECT p.result <> :success FROM builds AS p '
+        '     WHERE p.builder = b.builder AND p.build < b.build '
+        '     AND p.result IN (:success, :failure, :exception) '
+        '     ORDER BY p.build DESC LIMIT 1) AS prev_failed '
+        '  FROM builds AS b JOIN selected USING (builder) '
+        '  WHERE b.result IN (:success, :failure, :exception)) '
+        'GROUP BY builder ORDER BY builder' % _failing_id(),
+        {'success': S_SUCCESS, 'failure': S_FAILURE,
+         'exception': S_EXCEPTION}).fetchall()
+
+
+def query_test_stats(names):
+    """Return the failure statistics of the failed tests, from the cache.
+
+    Each row is (test, builders, builds, failed, flips, first, last).
+    Only the builds which succeeded, or which failed and list their
+    failed tests, are counted, on the builders where the test failed.
+    The flips are the changes between success and failure of the test,
+    from a build to the next one on the same builder.  The flakiest
+    tests come first.
+    """
+    unit_of_work.flush()
+    _select_builders(names)
+    # The builds which ran the tests, numbered in order of builder and
+    # build: the previous build of a builder has the previous id
+    conn.execute('DROP TABLE IF EXISTS temp.runs')
+    conn.execute('CREATE TEMP TABLE runs(id INTEGER PRIMARY KEY, '
+                 'builder TEXT NOT NULL, build INTEGER NOT NULL, ident)')
+    conn.execute(
+        'INSERT INTO runs(builder, build, ident) '
+        'SELECT b.builder, b.build, %s FROM builds AS b '
+        'JOIN selected USING (builder) WHERE b.result = :success OR '
+        '(b.result = :failure AND EXISTS(SELECT 1 FROM failures AS f '
+        ' WHERE f.builder = b.builder AND f.build = b.build)) '
+        'ORDER BY b.builder, b.build' % _failing_id(),
+        {'success': S_SUCCESS, 'failure': S_FAILURE})
+    conn.execute('DROP TABLE IF EXISTS temp.failed_runs')
+    conn.execute('CREATE TEMP TABLE failed_runs(test TEXT NOT NULL, '
+                 'id INTEGER NOT NULL, PRIMARY KEY (test, id))')
+    conn.execute('INSERT OR IGNORE INTO failed_runs(test, id) '
+                 'SELECT f.failed, r.id FROM runs AS r JOIN failures AS f '
+                 'ON f.builder = r.builder AND f.build = r.build')
+    # Count the flips from the failed runs only: a flip is a neighbour
+    # run of the same builder, where the test did not fail
+    flip = ('(EXISTS(SELECT 1 FROM runs AS n WHERE n.id = fr.id %s 1 '
+            'AND n.builder = r.builder) AND NOT EXISTS(SELECT 1 FROM '
+            'failed_runs AS nf WHERE nf.test = fr.test AND nf.id = fr.id '
+            '%s 1))')
+    return conn.execute(
+        'SELECT test, COUNT(*), SUM(runs), SUM(failed), SUM(flips), '
+        'MIN(first), MAX(last) FROM ('
+        '  SELECT fr.test, r.builder, COUNT(*) AS failed, '
+        '    SUM(%s + %s) AS flips, MIN(r.ident) AS first, '
+        '    MAX(r.ident) AS last '
+        '  FROM failed_runs AS fr JOIN runs AS r ON r.id = fr.id '
+        '  GROUP BY fr.test, r.builder) '
+        'JOIN (SELECT builder, COUNT(*) AS runs FROM runs '
+        '      GROUP BY builder) USING (builder) '
+        'GROUP BY test ORDER BY 5 DESC, 4 DESC, test' %
+        (flip % ('-', '-'), flip % ('+', '+'))).fetchall()
+
+
+def get_metadata(key):
+    # Return the value stored in the local cache, or None
+    if conn is None:
+        return None
+    row = conn.execute('SELECT value FROM metadata WHERE key = ?',
+                       (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_metadata(key, value):
+    if conn is not None:
+        conn.execute('INSERT OR REPLACE INTO metadata(key, value) '
+                     'VALUES (?, ?)', (key, value))
+
+
+def save_database():
+    # Commit the changes to the database file
+    unit_of_work.flush()
+    negative_cache.save()
+    log_store.evict()
+    conn.commit()
+
+
+def close_database():
+    global conn
+    if conn is not None:
+        conn.close()
+        conn = None
 
 
-def dump_database():
-    # Backup previous dump (and overwrite existing backup)
-    if os.path.exists(dbfile):
-        shutil.move(dbfile, dbfile + '.bak')
-    # Dump the database
-    with closing(gzip.open(dbfile, 'wb')) as f:
-        f.writelines(b(l + os.linesep) for l in conn.iterdump())
+# ~~ Report server ~~
+
+
+class ReportHandler:
+    """Serve the last JSON report, at "/" or at the name of the jsonfile.
+
+    Mixin for the BaseHTTPRequestHandler, which is imported on demand.
+    Like it, this is a classic class on Python 2.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'bbreport/' + __version__
+    paths = ('/',)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_report(self, with_body=True):
+        if urlsplit(self.path)[2] not in self.paths:
+            self.send_error(404)
+            return
+        (etag, body, gzbody) = self.server.report.snapshot()
+        if body is None:
+            self.send_error(503)
+            return
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzbody
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_report()
+
+    def do_HEAD(self):
+        self.send_report(with_body=False)
+
+
+class ReportServer(object):
+    """HTTP server for the JSON report, in a background thread.
+
+    The response body is serialized and compressed once, when the report
+    is published with different data.  The ETag is the digest of these
+    data, and the "changed" date is the date of the last change.
+    """
+
+    def __init__(self, address):
+        # The jsonfile may be changed by the configuration
+        paths = ('/', '/' + os.path.basename(jsonfile))
+        handler = type('ReportHandler', (ReportHandler,
+                                         http_server.BaseHTTPRequestHandler,
+                                         object),
+                       {'timeout': SERVE_INTERVAL, 'paths': paths})
+        server = type('ThreadingHTTPServer', (socketserver.ThreadingMixIn,
+                                              http_server.HTTPServer, object),
+                      {'daemon_threads': True})
+        self.httpd = server(address, handler)
+        self.httpd.report = self
+        self.server_address = self.httpd.server_address
+        self.lock = threading.Lock()
+        self.digest = None
+        self._snapshot = (None, None, None)
+
+    def snapshot(self):
+        """Return the ETag, the body and the gzip-encoded body."""
+        with self.lock:
+            return self._snapshot
+
+    def publish(self, report):
+        """Publish a new report, and return True if it changed."""
+        data = dict(report)
+        del data['changed']
+        digest = hashlib.sha1(b(json.dumps(data, sort_keys=True))).hexdigest()
+        if digest == self.digest:
+            return False
+        body = b(json.dumps(report, indent=1, separators=(',', ': ')))
+        buf = BytesIO()
+        with closing(gzip.GzipFile(fileobj=buf, mode='wb')) as f:
+            f.write(body)
+        with self.lock:
+            self.digest = digest
+            self._snapshot = ('"%s"' % digest, body, buf.getvalue())
+        return True
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def start_server(address):
+    """Start the report server on the "HOST:PORT" address."""
+    global report_server
+    (host, port) = address.rsplit(':', 1)
+    report_server = ReportServer((host, int(port)))
+    report_server.start()
+    out('Serving the report on http://%s:%s/' % report_server.server_address)
 
 
 # ~~ Application configuration ~~
@@ -1191,6 +2958,12 @@ def parse_args():
     parser.add_option('-l', '--limit', default=0, type="int",
                       help='limit the number of builds per builder '
                            '(default: %s)' % NUMBUILDS)
+    parser.add_option('-j', '--jobs', default=0, type="int",
+                      help='number of builders retrieved in parallel '
+                           '(default: %s)' % DEFAULT_JOBS)
+    parser.add_option('-p', '--processes', default=0, type="int",
+                      help='number of processes which parse the stdio logs '
+                           '(default: %s)' % DEFAULT_PROCESSES)
     parser.add_option('-r', '--revision',
                       help='minimum revision number',
                       type='int', default=None)
@@ -1200,13 +2973,33 @@ def parse_args():
                       help='one line per builder, or group by status with -qq')
     parser.add_option('-o', '--offline', default=False, action='store_true',
                       help='use only the local database; no update')
+    parser.add_option('-w', '--watch', default=0, type='int',
+                      metavar='INTERVAL',
+                      help='refresh the report every INTERVAL seconds')
+    parser.add_option('--serve', default=None, metavar='HOST:PORT',
+                      help='serve the JSON report over HTTP, and refresh '
+                           'it every %s seconds, or INTERVAL' %
+                           SERVE_INTERVAL)
+    parser.add_option('--deadline', default=0, type='float',
+                      metavar='SECONDS',
+                      help='stop retrieving the builds after SECONDS, and '
+                           'report the stale builders from the local cache')
+    parser.add_option('--stats', default=False, action='store_true',
+                      help='print the timings and the counters of the run')
+    parser.add_option('--stats-json', default=None, metavar='FILE',
+                      help='write the timings and the counters to FILE')
+    parser.add_option('--reparse', default=False, action='store_true',
+                      help='parse again the stored logs of the cached builds '
+                           '(see LOGSTORE_SIZE), and exit')
     parser.add_option('--no-color', default=False, action='store_true',
                       help='do not color the output')
     parser.add_option('--no-database', default=False, action='store_true',
                       help='do not cache the result in a database file')
     parser.add_option('--mode', default="builder", type="choice",
-                      choices=("builder", "revision", "issue", "json"),
-                      help='output mode: "builder", "revision" or "issue"')
+                      choices=("builder", "revision", "issue", "json",
+                               "stats"),
+                      help='output mode: "builder", "revision", "issue", '
+                           '"json" or "stats"')
     parser.add_option('--id', default="revision", type="choice",
                       choices=("revision", "build"),
                       help='build identifier: "revision" or "build"')
@@ -1219,6 +3012,26 @@ def parse_args():
         out("--offline and --no-database don't go together")
         sys.exit(1)
 
+    if options.mode == 'stats' and options.no_database:
+        out("--mode stats and --no-database don't go together")
+        sys.exit(1)
+
+    if options.reparse and options.no_database:
+        out("--reparse and --no-database don't go together")
+        sys.exit(1)
+
+    if options.offline and options.watch:
+        out("--offline and --watch don't go together")
+        sys.exit(1)
+
+    if options.deadline < 0:
+        out("--deadline requires a positive number of seconds")
+        sys.exit(1)
+
+    if options.serve and not re.match(r'.*:\d+$', options.serve):
+        out("--serve requires an address HOST:PORT")
+        sys.exit(1)
+
     return options, args
 
 
@@ -1251,8 +3064,9 @@ def configure():
             rule = tuple(arg.strip() for arg in val.split(':'))
             issues._preload.append((num, rule))
 
-    # Set timeout
-    socket.setdefaulttimeout(DEFAULT_TIMEOUT)
+    if options.no_color:
+        # replace the colorizer
+        cformat = _cformat_plain
 
     # Prepare the output colors
     prepare_output()
@@ -1266,10 +3080,6 @@ def configure():
         # ignore the -q option
         options.quiet = 0
 
-    if options.no_color:
-        # replace the colorizer
-        cformat = _cformat_plain
-
     if options.id == "build":
         # Use the build number as identifier
         BUILD_ID = "num"
@@ -1281,34 +3091,148 @@ def configure():
 # ~~ Main function ~~
 
 
+def query_last_builds(proxy, limit):
+    """Return the last XMLRPC build tuples of all builders, by name."""
+    xrlastbuilds = {}
+    for xrb in proxy.getLastBuildsAllBuilders(limit):
+        xrlastbuilds.setdefault(xrb[0], []).append(xrb)
+    return xrlastbuilds
+
+
+def query_builder_builds(proxy, names, n):
+    """Return the last n XMLRPC build tuples of the builders, by name.
+
+    The getLastBuilds calls are batched in MultiCall requests, or made
+    one by one if the server does not support them.  The builders which
+    give an error are skipped.
+    """
+    xrbuilds = {}
+    multicall = MULTICALL_CHUNK > 1
+    chunk_size = max(MULTICALL_CHUNK, 1)
+    for idx in range(0, len(names), chunk_size):
+        chunk = names[idx:idx + chunk_size]
+        results = None
+        if multicall:
+            batch = xmlrpclib.MultiCall(proxy)
+            for name in chunk:
+                batch.getLastBuilds(name, n)
+            try:
+                results = batch()
+            except xmlrpclib.Fault:
+                # The server does not support system.multicall
+                multicall = False
+        for (pos, name) in enumerate(chunk):
+            try:
+                if results is None:
+                    xrbuilds[name] = proxy.getLastBuilds(name, n)
+                else:
+                    xrbuilds[name] = results[pos]
+            except xmlrpclib.Fault:
+                pass
+    return xrbuilds
+
+
+def watch(options, proxy, numbuilds, report):
+    """Refresh the builds and render the report, until interrupted.
+
+    Only the new builds are retrieved, and the local cache is committed
+    every WATCH_CHECKPOINT seconds.
+    """
+    global deadline
+    limit = min(XMLRPC_LIMIT, numbuilds)
+    checkpoint = time.time()
+    try:
+        while True:
+            time.sleep(options.watch)
+            if options.deadline:
+                deadline = time.time() + options.deadline
+            try:
+                xrlastbuilds = query_last_builds(proxy, limit)
+            except (xmlrpclib.Error, socket.error):
+                out('***', exc() + ', unable to retrieve the last builds')
+                continue
+
+            def refresh_builds(builder):
+                xmlrpcbuilds = xrlastbuilds.get(str(builder), [])
+                builds = builder.refresh(numbuilds, *xmlrpcbuilds)
+                unit_of_work.flush()
+                return builder, builds
+
+            out()
+            out('... refreshed at %s' % time.strftime('%H:%M:%S'))
+            issues.reset_events()
+            report(refresh_builds)
+            if (conn is not None and
+                time.time() - checkpoint >= WATCH_CHECKPOINT):
+                prune_database()
+                save_database()
+                checkpoint = time.time()
+    except KeyboardInterrupt:
+        pass
+
+
 def main():
-    global conn
+    global conn, stats, deadline
 
     # Load configuration
     options, args = configure()
 
+    if options.stats or options.stats_json:
+        stats = Stats()
+
+    if options.deadline:
+        deadline = time.time() + options.deadline
+
+    processes = options.processes or DEFAULT_PROCESSES
+    if processes > 0 and (options.reparse or not options.offline):
+        # Start the processes before the threads and the database
+        start_parse_pool(processes)
+
     if not options.no_database:
         try:
             # Load the database
             load_database()
         except Exception:
-            conn = None
+            # Do not run without the cache silently
+            out('*** unable to load the database', dbfile + ':', exc())
+            out('*** fix it, or run with --no-database')
+            sys.exit(1)
+    end_phase('load database')
 
-    # Load issues (online or from cache)
-    issues.load(offline=options.offline)
+    if options.reparse:
+        if conn is None:
+            out('*** unable to load the database', dbfile)
+            sys.exit(1)
+        (count, changed) = reparse_logs()
+        stop_parse_pool()
+        out('Reparsed the logs of %d builds: %d changed' % (count, changed))
+        save_database()
+        close_database()
+        return []
+
+    # Load issues (online or from cache), unless no failure is rendered
+    if (options.mode in ('revision', 'issue', 'json') or options.serve or
+            (options.mode == 'builder' and options.quiet < 2)):
+        issues.load(offline=options.offline)
+    end_phase('load issues')
 
     builders = Builder.query_all()
     if not options.offline:
         # create the xmlrpc proxy to retrieve the build data
-        proxy = xmlrpclib.ServerProxy(baseurl + 'all/xmlrpc')
+        proxy = xmlrpclib.ServerProxy(baseurl + 'all/xmlrpc',
+                                      PooledTransport(urlsplit(baseurl)[0]))
 
-        # create the list of builders
-        try:
-            current_builders = set(proxy.getAllBuilders())
-        except socket.error:
-            # Network is unreachable
-            out('***', exc() + ', unable to refresh the list of builders')
+        # refresh the list of builders, if it is older than BUILDERS_TTL
+        refreshed = float(get_metadata('builders_refreshed') or 0)
+        if builders and time.time() - refreshed < BUILDERS_TTL:
             current_builders = None
+        else:
+            try:
+                current_builders = set(proxy.getAllBuilders())
+            except socket.error:
+                # Network is unreachable
+                out('***', exc() + ', unable to refresh the list of builders')
+                current_builders = None
 
         # Do nothing if the RPC call returns an empty set
         if current_builders:
@@ -1325,6 +3249,10 @@ def main():
             for name in added_builders:
                 builders[name] = Builder(name)
 
+            set_metadata('builders_refreshed', str(time.time()))
+
+    end_phase('list builders')
+
     # sort by branch and name
     builders = sorted(builders.values(), key=lambda b: (b.branch, str(b)))
 
@@ -1373,16 +3301,25 @@ def main():
         # don't overload the server with huge requests.
         limit = min(XMLRPC_LIMIT, numbuilds)
         try:
-            for xrb in proxy.getLastBuildsAllBuilders(limit):
-                xrlastbuilds.setdefault(xrb[0], []).append(xrb)
+            xrlastbuilds = query_last_builds(proxy, limit)
+            if numbuilds > limit:
+                # Retrieve the older builds with XMLRPC too, instead of
+                # the build pages
+                names = [str(builder) for builder in selected_builders
+                         if len(xrlastbuilds.get(str(builder), ())) == limit]
+                xrlastbuilds.update(query_builder_builds(proxy, names,
+                                                         numbuilds))
         except xmlrpclib.Error:
             out('*** xmlrpclib.Error:', exc())
         except socket.error:
             # Network is unreachable
             out('***', exc() + ', unable to retrieve the last builds')
-            if not options.no_database:
+            # After the deadline, the builders are reported as stale
+            # from the local cache, by within_deadline() below
+            if not options.no_database and not deadline_expired():
                 out('*** running in offline mode')
                 options.offline = True
+    end_phase('last builds')
 
     if options.failures:
         out("... retrieving build results")
@@ -1392,47 +3329,102 @@ def main():
         output_class = RevisionOutput
     elif options.mode == "issue":
         output_class = IssueOutput
-    elif options.mode == "json":
+    elif options.mode == "json" or options.serve:
         output_class = JsonOutput
+    elif options.mode == "stats":
+        output_class = StatsOutput
     else:
         output_class = BuilderOutput
-    output = output_class(options)
-    for builder in selected_builders:
 
-        # These data are accumulated in a list of results which is
-        # passed to a printer function.  The same list may be used
-        # to generate other kind of reports (e.g. HTML, XML, ...).
+    if options.offline:
+        # Read the cached builds
+        saved_builds = Builder.query_saved_builds(selected_builders,
+                                                  numbuilds)
 
+    def retrieve_builds(builder):
         if options.offline:
-            # Read the cached builds
-            builds = builder.get_saved_builds(numbuilds)
-        else:
-            # If the builder is working, the list may be partial or empty.
-            xmlrpcbuilds = xrlastbuilds.get(str(builder), [])
-
-            builds = list(builder.get_builds(numbuilds, *xmlrpcbuilds))
+            return builder, saved_builds[str(builder)]
+        # If the builder is working, the list may be partial or empty.
+        xmlrpcbuilds = xrlastbuilds.get(str(builder), [])
+        builds = list(builder.get_builds(numbuilds, *xmlrpcbuilds))
+        unit_of_work.flush()
+        return builder, builds
+
+    def within_deadline(retrieve_builds):
+        # After the deadline, the builds are read from the local cache
+        def retrieve(builder):
+            if options.offline or not deadline_expired():
+                builder, builds = retrieve_builds(builder)
+                if options.offline or not deadline_expired():
+                    return builder, builds, False
+            return builder, builder.restore(numbuilds), True
+        return retrieve
+
+    def report(retrieve_builds):
+        output = output_class(options)
+        if stats is not None:
+            retrieve_builds = stats.timed_builders(retrieve_builds)
+
+        # The builds are retrieved in parallel, and added in order
+        jobs = 1 if options.offline else (options.jobs or DEFAULT_JOBS)
+        for builder, builds, stale in parallel_map(
+                within_deadline(retrieve_builds), selected_builders, jobs):
+
+            # These data are accumulated in a list of results which is
+            # passed to a printer function.  The same list may be used
+            # to generate other kind of reports (e.g. HTML, XML, ...).
+
+            # filter by revision number
+            if options.revision:
+                builds = [b for b in builds if b.revision >= options.revision]
+
+            # fill the build list with None for missing builds.
+            builds.extend([None] * (numbuilds - len(builds)))
+
+            if (options.failures and
+                not any(build is not None and build.failed_tests and
+                        set(options.failures) <= set(build.failed_tests)
+                        for build in builds)):
+                # no build matched the options.failures
+                continue
 
-        # filter by revision number
-        if options.revision:
-            builds = [b for b in builds if b.revision >= options.revision]
+            if stale:
+                output.add_stale(str(builder))
+            output.add_builds(str(builder), builds)
 
-        # fill the build list with None for missing builds.
-        builds.extend([None] * (numbuilds - len(builds)))
+        output.display()
 
-        if (options.failures and
-            not any(build is not None and build.failed_tests and
-                    set(options.failures) <= set(build.failed_tests)
-                    for build in builds)):
-            # no build matched the options.failures
-            continue
+    if options.serve:
+        start_server(options.serve)
+        options.watch = options.watch or SERVE_INTERVAL
 
-        output.add_builds(str(builder), builds)
+    report(retrieve_builds)
+    end_phase('builds and output')
 
-    output.display()
+    if options.watch and not options.offline:
+        watch(options, proxy, numbuilds, report)
+        end_phase('watch')
+    elif report_server is not None:
+        # Serve the cached report, until interrupted
+        try:
+            while True:
+                time.sleep(options.watch)
+        except KeyboardInterrupt:
+            pass
+        end_phase('serve')
+    stop_parse_pool()
 
     if not options.offline and conn is not None:
         prune_database()
-        dump_database()
+        save_database()
+    close_database()
+    end_phase('save database')
+
+    if options.stats_json:
+        with open(options.stats_json, 'w') as f:
+            json.dump(stats.as_dict(), f, indent=1, separators=(',', ': '))
+    if options.stats:
+        stats.display()
 
     return builders
 